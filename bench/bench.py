@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+from fixtures import PAGES, make_server
+import urllib.request
+import urllib.error
+import threading
+import argparse
+import json
+import time
+import sys
+import re
+
+
+"""
+
+Drives /scrape against the local fixture server and reports latency, throughput, memory, and time per stage.
+
+See README.md in this folder for how to run the scraper so that it works fully offline.
+
+"""
+
+parser = argparse.ArgumentParser(description='Benchmark the scrape server.')
+parser.add_argument('--server', type=str, default='http://localhost:5006', help='The scrape server')
+parser.add_argument('--api-key', type=str, default="", help='The API key for your server, if set')
+parser.add_argument('--fixture-port', type=int, default=8800, help='Port for the fixture server started by this script')
+parser.add_argument('--fixture-base', type=str, default=None, help='Base URL the scraper uses to reach the fixtures (default: http://127.0.0.1:<fixture-port>)')
+parser.add_argument('--no-fixtures', action='store_true', help="Don't start the fixture server (i.e., it's already running elsewhere)")
+parser.add_argument('--pages', type=str, nargs='+', default=list(PAGES.keys()), help=f'Which fixture pages to scrape ({", ".join(PAGES.keys())})')
+parser.add_argument('--requests', type=int, default=40, help='Total number of scrapes')
+parser.add_argument('--concurrency', type=int, default=4, help='Scrapes in flight at once')
+parser.add_argument('--wait', type=int, default=None, help='wait argument for each scrape')
+parser.add_argument('--max-screenshots', type=int, default=None, help='max_screenshots argument for each scrape')
+parser.add_argument('--capture-mode', type=str, default=None, help='capture_mode argument for each scrape')
+parser.add_argument('--readiness', type=str, default=None, help='readiness argument for each scrape')
+parser.add_argument('--use-cache', action='store_true', help="Allow cached results (by default every scrape sets no_cache)")
+parser.add_argument('--json-out', type=str, default=None, help='Also write the results as JSON to this file, for comparing across commits')
+
+
+def percentile(values, p):
+    if not len(values):
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(values):
+    return {
+        'n': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+def scrape(args, url):
+    data = {
+        'url': url,
+        'no_cache': not args.use_cache,
+        **{k: v for k, v in {
+            'wait': args.wait,
+            'max_screenshots': args.max_screenshots,
+            'capture_mode': args.capture_mode,
+            'readiness': args.readiness,
+        }.items() if v is not None}
+    }
+    req = urllib.request.Request(
+        f"{args.server}/scrape",
+        data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {args.api_key}'},
+        method='POST'
+    )
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            body = json.loads(resp.read())
+            return time.monotonic() - start, resp.status, body
+    except urllib.error.HTTPError as e:
+        return time.monotonic() - start, e.code, None
+    except Exception as e:
+        print(f"Request failed: {e}", file=sys.stderr)
+        return time.monotonic() - start, None, None
+
+
+# Polls /metrics for the summed worker RSS until stop is set; returns the peak in bytes
+def watch_rss(args, stop, peak):
+    pattern = re.compile(r'^scrapeserv_worker_rss_bytes(?:\{[^}]*\})? ([0-9.e+]+)$', re.MULTILINE)
+    req = urllib.request.Request(f"{args.server}/metrics", headers={'Authorization': f'Bearer {args.api_key}'})
+    while not stop.is_set():
+        try:
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                text = resp.read().decode('utf-8')
+            total = sum(float(m) for m in pattern.findall(text))
+            peak[0] = max(peak[0], total)
+        except Exception:
+            pass
+        stop.wait(0.5)
+
+
+def main():
+    args = parser.parse_args()
+    fixture_base = args.fixture_base or f"http://127.0.0.1:{args.fixture_port}"
+
+    if not args.no_fixtures:
+        server = make_server('0.0.0.0', args.fixture_port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    urls = [(page, f"{fixture_base}{PAGES[page]}") for page in args.pages]
+    jobs = [urls[i % len(urls)] for i in range(args.requests)]
+
+    stop = threading.Event()
+    peak_rss = [0]
+    rss_thread = threading.Thread(target=watch_rss, args=(args, stop, peak_rss), daemon=True)
+    rss_thread.start()
+
+    print(f"Running {len(jobs)} scrapes of {', '.join(args.pages)} at concurrency {args.concurrency}...", file=sys.stderr)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda job: (job[0], *scrape(args, job[1])), jobs))
+    elapsed = time.monotonic() - start
+    stop.set()
+    rss_thread.join()
+
+    by_page = {}
+    stages = {}
+    for page, latency, status, body in results:
+        entry = by_page.setdefault(page, {'latencies': [], 'errors': 0})
+        if status == 200 and body:
+            entry['latencies'].append(latency)
+            for stage, seconds in body.get('metadata', {}).get('timings', {}).items():
+                stages.setdefault(stage, []).append(seconds)
+        else:
+            entry['errors'] += 1
+
+    all_latencies = [l for e in by_page.values() for l in e['latencies']]
+    report = {
+        'requests': len(jobs),
+        'concurrency': args.concurrency,
+        'elapsed_seconds': elapsed,
+        'jobs_per_second': len(all_latencies) / elapsed if elapsed else None,
+        'errors': sum(e['errors'] for e in by_page.values()),
+        'peak_worker_rss_mb': peak_rss[0] / (1024 * 1024) if peak_rss[0] else None,
+        'latency_seconds': summarize(all_latencies),
+        'pages': {page: {**summarize(e['latencies']), 'errors': e['errors']} for page, e in by_page.items()},
+        'stages_seconds': {stage: summarize(values) for stage, values in sorted(stages.items())},
+    }
+
+    def fmt(x):
+        return "-" if x is None else f"{x:.3f}"
+
+    print(f"\nJobs/sec: {fmt(report['jobs_per_second'])}  Errors: {report['errors']}  Peak worker RSS (MB): {fmt(report['peak_worker_rss_mb'])}")
+    print(f"\n{'latency (s)':<20}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>8}")
+    overall = report['latency_seconds']
+    print(f"{'all':<20}{overall['n']:>6}{fmt(overall['p50']):>10}{fmt(overall['p95']):>10}{fmt(overall['p99']):>10}{report['errors']:>8}")
+    for page, s in report['pages'].items():
+        print(f"{page:<20}{s['n']:>6}{fmt(s['p50']):>10}{fmt(s['p95']):>10}{fmt(s['p99']):>10}{s['errors']:>8}")
+    print(f"\n{'stage (s)':<20}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, s in report['stages_seconds'].items():
+        print(f"{stage:<20}{s['n']:>6}{fmt(s['p50']):>10}{fmt(s['p95']):>10}{fmt(s['p99']):>10}")
+
+    if args.json_out:
+        with open(args.json_out, 'w') as fhand:
+            json.dump(report, fhand, indent=2)
+        print(f"\nResults written to {args.json_out}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse
+import struct
+import random
+import time
+import zlib
+
+
+"""
+
+A local web server with synthetic pages for benchmarking the scraper offline.
+
+Every page is generated, so results only depend on the scraper (and the machine).
+Run it on its own with `python3 fixtures.py --port 8800`, or let bench.py start it.
+
+"""
+
+PAGES = {
+    'short': '/short',
+    'tall': '/tall?height=30000',
+    'images': '/images?n=40',
+    'slow': '/slow?delay=2000',
+    'redirect': '/redirect?n=3',
+    'download': '/download?size=2000000',
+    'json': '/json',
+    'pdf': '/pdf',
+}
+
+
+# Random.randbytes is Python 3.9+; the image runs 3.8
+def random_bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, 'big') if n else b""
+
+
+def make_png(width, height, seed=0, noisy=True):
+    """
+    Returns PNG bytes. Noisy images are random (incompressible), so they're realistically heavy.
+    """
+    rng = random.Random(seed)
+    if noisy:
+        rows = b"".join(b"\x00" + random_bytes(rng, width * 3) for _ in range(height))
+    else:
+        color = bytes([rng.randrange(256) for _ in range(3)])
+        rows = (b"\x00" + color * width) * height
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (
+        b"\x89PNG\r\n\x1a\n" +
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+        chunk(b"IDAT", zlib.compress(rows, 1)) +
+        chunk(b"IEND", b"")
+    )
+
+
+def html_page(title, body):
+    return f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title>
+<style>body {{ font-family: sans-serif; margin: 0; }} .block {{ padding: 20px; }}</style>
+</head>
+<body>{body}</body>
+</html>""".encode('utf-8')
+
+
+# A tiny but valid PDF
+PDF_BYTES = b"""%PDF-1.4
+1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj
+2 0 obj << /Type /Pages /Kids [3 0 R] /Count 1 >> endobj
+3 0 obj << /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >> endobj
+trailer << /Root 1 0 R >>
+%%EOF
+"""
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # Too noisy under load
+
+    def _send(self, status, content_type, body, extra_headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (extra_headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        path = parsed.path
+
+        if path == '/short':
+            self._send(200, 'text/html; charset=utf-8', html_page('Short', '<h1>Short page</h1><p>Hello, world.</p>'))
+
+        elif path == '/tall':
+            height = int(q.get('height', 30000))
+            blocks = "".join(
+                f'<div class="block" style="height: 960px; background: hsl({(i * 37) % 360}, 60%, 85%)"><h2>Section {i}</h2><p>{"Lorem ipsum dolor sit amet. " * 40}</p></div>'
+                for i in range(max(height // 1000, 1))
+            )
+            self._send(200, 'text/html; charset=utf-8', html_page('Tall', blocks))
+
+        elif path == '/images':
+            n = int(q.get('n', 40))
+            imgs = "".join(f'<img src="/img?seed={i}&w=400&h=300" width="400" height="300">' for i in range(n))
+            self._send(200, 'text/html; charset=utf-8', html_page('Images', f'<h1>Images</h1>{imgs}'))
+
+        elif path == '/img':
+            w, h = int(q.get('w', 400)), int(q.get('h', 300))
+            self._send(200, 'image/png', make_png(w, h, seed=int(q.get('seed', 0))), {'Cache-Control': 'no-store'})
+
+        elif path == '/slow':
+            delay = int(q.get('delay', 2000))
+            body = f'<h1>Slow resources</h1><img src="/slow-resource?delay={delay}&kind=img" width="400" height="300"><script src="/slow-resource?delay={delay}&kind=js"></script>'
+            self._send(200, 'text/html; charset=utf-8', html_page('Slow', body))
+
+        elif path == '/slow-resource':
+            time.sleep(int(q.get('delay', 2000)) / 1000)
+            if q.get('kind') == 'js':
+                self._send(200, 'application/javascript', b'document.body.insertAdjacentHTML("beforeend", "<p>Script loaded</p>");')
+            else:
+                self._send(200, 'image/png', make_png(400, 300, noisy=False))
+
+        elif path == '/redirect':
+            n = int(q.get('n', 1))
+            location = f'/redirect?n={n-1}' if n > 1 else '/short'
+            self._send(302, 'text/plain', b'', {'Location': location})
+
+        elif path == '/download':
+            size = int(q.get('size', 2_000_000))
+            self._send(200, 'application/octet-stream', random_bytes(random.Random(size), size), {'Content-Disposition': 'attachment; filename="data.bin"'})
+
+        elif path == '/json':
+            self._send(200, 'application/json', b'{"hello": "world", "items": [' + b",".join(str(i).encode() for i in range(1000)) + b']}')
+
+        elif path == '/pdf':
+            self._send(200, 'application/pdf', PDF_BYTES)
+
+        else:
+            self._send(404, 'text/plain', b'Not found')
+
+
+def make_server(host, port):
+    return ThreadingHTTPServer((host, port), FixtureHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic pages for benchmarking.')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8800, help='Port to listen on')
+    args = parser.parse_args()
+    print(f"Serving fixtures on {args.host}:{args.port}: {', '.join(PAGES.values())}")
+    make_server(args.host, args.port).serve_forever()
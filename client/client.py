@@ -5,6 +5,7 @@ import json
 import mimetypes
 import os
 import argparse
+from urllib.parse import urljoin
 
 
 """
@@ -53,8 +54,11 @@ def get_ext_from_headers(headers):
         return f"{extensions[0]}"
     return ""
 
+SERVER = 'http://localhost:5006'
+
 # Make the request to the API
-response = requests.post('http://localhost:5006/scrape', json=data, headers=headers, timeout=30)
+# With stream, the response is multipart/mixed and its parts are sent as soon as they're ready (see the API reference)
+response = requests.post(f'{SERVER}/scrape', json={**data, 'stream': True}, headers=headers, timeout=60)
 
 if response.status_code != 200:  # Handle errors
     my_json = response.json()
@@ -62,37 +66,39 @@ if response.status_code != 200:  # Handle errors
     print(f"Error scraping: {message}", file=sys.stderr)
 else:  # Scrape went through
     decoder = MultipartDecoder.from_response(response)  # Response is type multipart/mixed
-    resp = None
-    for i, part in enumerate(decoder.parts):
-        if i == 0:  # First is some JSON containing headers, status code, and other metadata
+    if not os.path.exists(OUTFOLDER):
+        os.mkdir(OUTFOLDER)
+    for part in decoder.parts:
+        disposition = part.headers[b'Content-Disposition'].decode('utf-8')
+        name = disposition.split('name="')[1].split('"')[0]  # response, screenshot, result, or error
+
+        if name == 'response':  # Sent first: JSON containing the status code and headers
             json_part = json.loads(part.content)
             req_status = json_part['status']  # An integer
             req_headers: dict = json_part['headers']  # Headers from the request made to your URL
-            _ = json_part['metadata']  # For reference, information like the number of screenshots and their compressed / uncompressed sizes
-            
+
             print(f"Status Code: {req_status}", end="\n\n")
             print("\n".join([f"{k}: {v}" for k, v in req_headers.items()]))
 
-        elif i == 1:  # Next is the actual content of the page
-            if not os.path.exists(OUTFOLDER):
-                os.mkdir(OUTFOLDER)
-            
-            content = part.content
-            headers = part.headers  # Will contain info about the content (text/html, application/pdf, etc.)
-            ext = get_ext_from_headers(headers)
-            outfile = os.path.join(OUTFOLDER, f"main{ext}")
-            with open(outfile, 'wb') as fhand:  # Save the file
-                fhand.write(content)
-
-            print(f"\nFile written to {outfile}.")
-
-        else:  # Other parts are screenshots, if they exist
+        elif name == 'screenshot':  # Each screenshot, as soon as it's ready (possibly out of order)
             img = part.content
-            headers = part.headers  # Will tell you the image format
-            ext = get_ext_from_headers(headers)
-            outfile = os.path.join(OUTFOLDER, f"{i-1}{ext}")
+            index = int(part.headers[b'X-Segment-Index'])
+            ext = get_ext_from_headers(part.headers)  # Will tell you the image format
+            outfile = os.path.join(OUTFOLDER, f"{index}{ext}")
             with open(outfile, 'wb') as fhand:
                 fhand.write(img)
-            
+
             print(f"Screenshot written to {outfile}.")
 
+        elif name == 'result':  # Last: the full result, including the URL of the page's content and metadata
+            result = json.loads(part.content)
+            content = requests.get(urljoin(SERVER, result['content_url']), timeout=30)  # Relative if the server stores files locally
+            ext = mimetypes.guess_extension(result['headers'].get('content-type', '').split(';')[0].strip()) or ""
+            outfile = os.path.join(OUTFOLDER, f"main{ext}")
+            with open(outfile, 'wb') as fhand:  # Save the file
+                fhand.write(content.content)
+
+            print(f"\nFile written to {outfile}.")
+
+        else:  # error
+            print(f"Error scraping: {json.loads(part.content)['error']}", file=sys.stderr)
@@ -0,0 +1,205 @@
+from celery.worker.autoscale import Autoscaler
+import threading
+import socket
+import psutil
+import json
+import math
+import time
+import sys
+import os
+
+"""
+
+Admission control: decides whether there's room for a new scrape before it's queued, based on live memory and CPU rather than fixed limits.
+
+- Every worker node publishes its available memory, CPU use, and number of task slots to Redis every few seconds (NodeReporter).
+- Each job's memory is estimated from its browser dimensions and number of screenshots (estimate_job_mb).
+- When a job is admitted, its estimate is reserved until it starts running (after which it shows up in the node's live memory).
+- A job is rejected (HTTP 429 with Retry-After) if its estimate doesn't fit in the free memory of any one node, after reservations and headroom,
+  if every node's CPU is saturated, or if the queue is already longer than the slots can work through in time.
+
+Worker nodes also scale their number of processes with free memory (MemoryAwareAutoscaler), so big hosts are fully used.
+
+"""
+
+NODES_KEY = "scrapeserv:admission:nodes"
+RESERVED_KEY = "scrapeserv:admission:reserved"
+LOCK_KEY = "scrapeserv:admission:lock"
+MB = 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def estimate_job_mb(browser_dim, n_screenshots, capture_mode, base_mb, frame_factor, fullpage_max_capture_height):
+    """
+    Rough peak memory for one scrape: a fixed cost for the page, plus a cost proportional to the viewport's area for rendering,
+    plus the raw frames held at once (two while scrolling; a whole chunk when capturing full pages).
+    """
+    frame_mb = browser_dim[0] * browser_dim[1] * 4 / MB
+    if capture_mode == 'fullpage':
+        frames_held = min(n_screenshots, max(fullpage_max_capture_height // browser_dim[1], 1))
+    else:
+        frames_held = min(n_screenshots, 2)
+    return base_mb + frame_mb * (frame_factor + frames_held)
+
+
+def node_stats(slots, busy):
+    memory = psutil.virtual_memory()
+    return {
+        'available_mb': memory.available / MB,
+        'total_mb': memory.total / MB,
+        'cpu_percent': psutil.cpu_percent(interval=None),
+        'slots': slots,
+        'busy': busy,
+    }
+
+
+class NodeReporter:
+    """
+    Runs in a worker node's main process, publishing its live capacity to Redis.
+    """
+    def __init__(self, redis_client, interval, get_slots, get_busy):
+        self.redis = redis_client
+        self.interval = interval
+        self.get_slots = get_slots
+        self.get_busy = get_busy
+        self.node = f"{socket.gethostname()}:{os.getpid()}"
+
+    def report(self):
+        stats = node_stats(self.get_slots(), self.get_busy())
+        stats['expires'] = time.time() + self.interval * 3
+        self.redis.hset(NODES_KEY, self.node, json.dumps(stats))
+
+    def _run(self):
+        psutil.cpu_percent(interval=None)  # The first call only starts measuring
+        while True:
+            try:
+                self.report()
+            except Exception as e:
+                print(f"Reporting node capacity failed: {e}", file=sys.stderr, flush=True)
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name='node-reporter').start()
+
+
+class AdmissionController:
+    def __init__(self, redis_client, headroom_mb, max_cpu_percent, max_queued_per_slot, job_seconds, reservation_ttl):
+        self.redis = redis_client
+        self.headroom_mb = headroom_mb
+        self.max_cpu_percent = max_cpu_percent
+        self.max_queued_per_slot = max_queued_per_slot
+        self.job_seconds = job_seconds  # Rough duration of a job, for Retry-After
+        self.reservation_ttl = reservation_ttl
+
+    def _live_nodes(self):
+        now = time.time()
+        nodes = {}
+        stale = []
+        for node, raw in self.redis.hgetall(NODES_KEY).items():
+            stats = json.loads(raw)
+            if stats['expires'] < now:
+                stale.append(node)
+            else:
+                nodes[node.decode('utf-8')] = stats
+        if len(stale):
+            self.redis.hdel(NODES_KEY, *stale)
+        return nodes
+
+    def _reservations(self):
+        now = time.time()
+        reservations = {}
+        expired = []
+        for job_id, raw in self.redis.hgetall(RESERVED_KEY).items():
+            entry = json.loads(raw)
+            if entry['expires'] < now:
+                expired.append(job_id)
+            else:
+                reservations[job_id.decode('utf-8')] = entry
+        if len(expired):
+            self.redis.hdel(RESERVED_KEY, *expired)
+        return reservations
+
+    def capacity(self):
+        nodes = self._live_nodes()
+        reservations = self._reservations()
+        reserved_mb = sum(r['cost_mb'] for r in reservations.values())
+        slots = sum(n['slots'] for n in nodes.values())
+        # A job runs on one node, so what matters is the most any single node has free
+        # Reservations aren't tied to a node yet; each is counted against whichever node has the most free at the time, as a job would be
+        node_free = [max(n['available_mb'] - self.headroom_mb, 0) for n in nodes.values()]
+        for r in sorted(reservations.values(), key=lambda r: r['cost_mb'], reverse=True):
+            if len(node_free):
+                most = max(range(len(node_free)), key=lambda i: node_free[i])
+                node_free[most] -= r['cost_mb']
+        return {
+            'nodes': nodes,
+            'slots': slots,
+            'busy': sum(n['busy'] for n in nodes.values()),
+            'queued': len(reservations),
+            'max_queued': slots * self.max_queued_per_slot,
+            'available_mb': round(sum(n['available_mb'] for n in nodes.values()), 1),
+            'reserved_mb': round(reserved_mb, 1),
+            'free_mb': round(sum(max(n['available_mb'] - self.headroom_mb, 0) for n in nodes.values()) - reserved_mb, 1),
+            'largest_free_mb': round(max(node_free, default=0), 1),
+            'cpu_saturated': bool(len(nodes)) and all(n['cpu_percent'] >= self.max_cpu_percent for n in nodes.values()),
+        }
+
+    def _retry_after(self, capacity):
+        slots = max(capacity['slots'], 1)
+        return max(1, math.ceil((capacity['queued'] + capacity['busy']) / slots) * self.job_seconds)
+
+    def admit(self, job_id, cost_mb):
+        """
+        Reserves cost_mb for the job, or raises AdmissionRejected.
+        """
+        with self.redis.lock(LOCK_KEY, timeout=5, blocking_timeout=5):
+            capacity = self.capacity()
+            if not len(capacity['nodes']):
+                # No worker is reporting (i.e., still starting up); let Celery queue the job rather than failing
+                print("Admission: no worker nodes reporting capacity; admitting", file=sys.stderr, flush=True)
+            elif capacity['cpu_saturated']:
+                raise AdmissionRejected('CPU is saturated', self._retry_after(capacity))
+            elif capacity['queued'] >= capacity['max_queued']:
+                raise AdmissionRejected('Queue is full', self._retry_after(capacity))
+            elif cost_mb > capacity['largest_free_mb']:
+                raise AdmissionRejected('Not enough free memory', self._retry_after(capacity))
+            self.redis.hset(RESERVED_KEY, job_id, json.dumps({'cost_mb': cost_mb, 'expires': time.time() + self.reservation_ttl}))
+
+    def release(self, job_id):
+        try:
+            self.redis.hdel(RESERVED_KEY, job_id)
+        except Exception as e:
+            print(f"Releasing reservation failed: {e}", file=sys.stderr, flush=True)
+
+
+class MemoryAwareAutoscaler(Autoscaler):
+    """
+    Celery autoscaler (see supervisord.conf) that only adds worker processes while there's free memory and CPU for them.
+    Set as worker_autoscaler in worker.py; process_mb, headroom_mb, and max_cpu_percent are set there too.
+    """
+    process_mb = 1000
+    headroom_mb = 1000
+    max_cpu_percent = 90
+
+    def _maybe_scale(self, req=None):
+        procs = self.processes
+        wanted = min(self.qty, self.max_concurrency)
+        if wanted > procs:
+            available_mb = psutil.virtual_memory().available / MB
+            room = math.floor((available_mb - self.headroom_mb) / self.process_mb)
+            if psutil.cpu_percent(interval=None) >= self.max_cpu_percent:
+                room = 0
+            if procs < self.min_concurrency:
+                room = max(room, self.min_concurrency - procs)
+            n = min(wanted - procs, room)
+            if n > 0:
+                self.scale_up(n)
+                return True
+            return False
+        return super()._maybe_scale(req)
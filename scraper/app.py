@@ -1,15 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context, send_from_directory, abort, g
 import sys
 import os
 from dotenv import load_dotenv
-import ipaddress
-import socket
 from urllib.parse import urlparse
-import os
-from worker import scrape_task, MAX_BROWSER_DIM, MIN_BROWSER_DIM, DEFAULT_BROWSER_DIM, DEFAULT_WAIT, MAX_SCREENSHOTS, MAX_WAIT, DEFAULT_SCREENSHOTS
+from worker import celery, scrape_chain, dns_resolver, metrics, progress_redis, admission, fair_scheduler, PRIORITIES, AdmissionRejected, MemoryLimitExceeded, RATE_LIMIT_PER_MINUTE, MAX_BROWSER_DIM, MIN_BROWSER_DIM, DEFAULT_BROWSER_DIM, DEFAULT_WAIT, MAX_SCREENSHOTS, MAX_WAIT, DEFAULT_SCREENSHOTS, JOB_RESULT_TTL, CELERY_BROKER_URL, MAX_BATCH_URLS, BATCH_TIMEOUT, CAPTURE_MODES, READINESS_MODES, DEFAULT_BLOCK_RESOURCE_TYPES, DEFAULT_BLOCK_TRACKERS, MAX_RESOURCE_BYTES, DEDUP_MODES, DEFAULT_DEDUP, DEFAULT_DEDUP_THRESHOLD, MAX_DEDUP_THRESHOLD
+from celery.result import AsyncResult
+from storage import get_storage, LocalStorage
+from progress import progress_channel, batch_channel
+from cancellation import request_cancel
 import json
-import mimetypes
-import boto3
+import base64
+import uuid
+import hashlib
+import time
+import redis
 from flask_cors import CORS
 
 
@@ -25,6 +29,7 @@ The server worker process spawned by gunicorn itself maintains a separate pool o
 Upon a request to /scrape, the gunicorn worker asks the pool for a process to run a scrape, which spawns an isolated browser context.
 
 The scrape workers' memory usage and number are limited by constants set in worker.py.
+When the workers don't have the memory or CPU for a new scrape, it's turned away with a 429 and a Retry-After header (see admission.py).
 
 """
 
@@ -32,31 +37,68 @@ The scrape workers' memory usage and number are limited by constants set in work
 load_dotenv()  # Load in API keys
 SCRAPER_API_KEYS = [value for key, value in os.environ.items() if key.startswith('SCRAPER_API_KEY')]
 
+redis_client = redis.Redis.from_url(CELERY_BROKER_URL)
+
+fair_scheduler.start()  # Releases bulk jobs to the workers (see scheduler.py)
+BATCH_SWEEP_INTERVAL = 5  # How often /scrape/batch checks every unfinished URL, besides listening for them to finish (seconds)
+SCRAPE_TIMEOUT = 60  # /scrape gives up after this long (seconds)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if request.endpoint not in (None, 'prometheus_metrics', 'static'):
+        batch = metrics.batch()
+        batch.observe('scrapeserv_request_seconds', time.monotonic() - g.request_start, {'endpoint': request.endpoint, 'status': response.status_code})
+        batch.flush()
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Protected like everything else if API keys are set; configure your Prometheus scrape job with the bearer token
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+    extra = []
+    try:
+        for queue in PRIORITIES:
+            extra.append(('scrapeserv_queue_depth', redis_client.llen(queue), {'queue': queue}))
+        for (owner, priority), depth in fair_scheduler.stats().items():
+            extra.append(('scrapeserv_key_queue_depth', depth, {'key': owner[:12], 'priority': priority}))
+    except redis.RedisError:
+        pass
+    return Response(metrics.render(extra_gauges=extra), mimetype='text/plain; version=0.0.4')
+
+
+# Live capacity of the worker nodes, as used for admission control
+@app.route('/capacity')
+def capacity():
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+    return jsonify(admission.capacity()), 200
+
+
+def rejected_response(e: AdmissionRejected):
+    resp = jsonify({'error': f'Server is at capacity ({e.reason}); try again later', 'retry_after': e.retry_after})
+    resp.headers['Retry-After'] = str(e.retry_after)
+    return resp, 429
+
 
 @app.route('/')
 def home():
     return "A rollicking band of pirates we, who tired of tossing on the sea, are trying our hands at burglary, with weapons grim and gory."
 
 
-def is_private_ip(ip_str: str) -> bool:
+def check_url(url: str, allowed_schemes=None):
     """
-    Checks if the given IP address string (e.g., '10.0.0.1', '127.0.0.1')
-    is private, loopback, or link-local.
+    Returns (host, ips) if the URL is safe to scrape, where ips are the validated addresses for host; otherwise (None, None).
     """
-    try:
-        ip_obj = ipaddress.ip_address(ip_str)
-        return (
-            ip_obj.is_loopback or
-            ip_obj.is_private or
-            ip_obj.is_reserved or
-            ip_obj.is_link_local or
-            ip_obj.is_multicast
-        )
-    except ValueError:
-        return True  # If it can't parse, treat as "potentially unsafe"
-
-
-def url_is_safe(url: str, allowed_schemes=None) -> bool:
     if allowed_schemes is None:
         # By default, let's only allow http(s)
         allowed_schemes = {"http", "https"}
@@ -64,41 +106,46 @@ def url_is_safe(url: str, allowed_schemes=None) -> bool:
     # Parse the URL
     parsed = urlparse(url.strip())
     scheme = parsed.scheme.lower()
-    netloc = parsed.netloc.split(':')[0]  # extract host portion w/o port
     if scheme not in allowed_schemes:
         print(f"URL blocked: scheme '{scheme}' is not allowed.", file=sys.stderr)
-        return False
+        return None, None
+
+    host = parsed.hostname  # host portion w/o port or credentials
+    if not host:
+        print(f"URL blocked: no host in {url}", file=sys.stderr)
+        return None, None
 
+    # Resolve the domain name (cached; see resolver.py) and check each address
     try:
-        # Resolve the domain name to IP addresses
-        # This can raise socket.gaierror if domain does not exist
-        addrs = socket.getaddrinfo(netloc, None)
-    except socket.gaierror:
-        print(f"URL blocked: cannot resolve domain {netloc}", file=sys.stderr)
-        return False
-
-    # Check each resolved address
-    for addrinfo in addrs:
-        ip_str = addrinfo[4][0]
-        if is_private_ip(ip_str):
-            print(f"URL blocked: IP {ip_str} for domain {netloc} is private/loopback/link-local.", file=sys.stderr)
-            return False
+        ips, reason = dns_resolver.resolve_safe(host)
+    except Exception as e:
+        ips, reason = None, f"resolving {host} failed ({e})"
+    if ips is None:
+        print(f"URL blocked: {reason}", file=sys.stderr)
+        return None, None
 
     # If all resolved IPs appear safe, pass it
-    return True
+    return host, ips
 
 
-# Includes dot
-def get_ext_from_content_type(content_type: str):
-    mime_type = content_type.split(';')[0].strip()
-    extensions = mimetypes.guess_all_extensions(mime_type)
-    if len(extensions):
-        return f"{extensions[0]}"
-    return ""
+def url_is_safe(url: str, allowed_schemes=None) -> bool:
+    host, _ = check_url(url, allowed_schemes=allowed_schemes)
+    return host is not None
 
 
-@app.route('/scrape', methods=('POST',))
-def scrape():
+# Serves uploaded artifacts when using the local filesystem storage backend (see storage.py)
+@app.route('/storage/<path:key>')
+def local_storage(key):
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+    return send_from_directory(storage.root, key)
+
+
+def check_auth():
+    """
+    Returns an error response if the request isn't authorized, otherwise None.
+    """
     if len(SCRAPER_API_KEYS):
         auth_header = request.headers.get('Authorization')
         if auth_header is None:
@@ -110,34 +157,123 @@ def scrape():
         user_key = auth_header.split(' ')[1]
         if user_key not in SCRAPER_API_KEYS:
             return jsonify({'error': 'Invalid API key'}), 401
+    return None
+
 
-    url = request.json.get('url')
+# Identifies the caller without storing their key
+# In /metrics, keys are labeled with the first 12 characters of this
+def get_owner():
+    auth_header = request.headers.get('Authorization', '')
+    return hashlib.sha256(auth_header.encode('utf-8')).hexdigest()
+
+
+def check_rate_limit(n=1):
+    """
+    Counts n scrapes against the caller's per-minute limit; returns a 429 response if that goes over it, otherwise None.
+    """
+    if not RATE_LIMIT_PER_MINUTE:
+        return None
+    window = int(time.time() // 60)
+    key = f"scrapeserv:rate:{get_owner()}:{window}"
+    pipe = redis_client.pipeline()
+    pipe.incrby(key, n)
+    pipe.expire(key, 120)
+    count, _ = pipe.execute()
+    if count > RATE_LIMIT_PER_MINUTE:
+        redis_client.decrby(key, n)  # Turned away, so they don't count
+        batch = metrics.batch()
+        batch.inc('scrapeserv_rate_limited_total', n)
+        batch.flush()
+        retry_after = 60 - int(time.time()) % 60
+        resp = jsonify({'error': f'Rate limit of {RATE_LIMIT_PER_MINUTE} scrapes per minute exceeded', 'retry_after': retry_after})
+        resp.headers['Retry-After'] = str(retry_after)
+        return resp, 429
+    return None
+
+
+def parse_scrape_args(params):
+    """
+    Validates the scrape arguments in params (usually the request's JSON).
+    Returns (args, None) where args is a dict of scrape_task arguments, or (None, error response).
+    """
+    url = params.get('url')
 
     if not url:
-        return jsonify({'error': 'No URL provided'}), 400
-    if not url_is_safe(url):
-        return jsonify({'error': 'URL was judged to be unsafe'}), 400
+        return None, (jsonify({'error': 'No URL provided'}), 400)
+    host, ips = check_url(url)
+    if host is None:
+        return None, (jsonify({'error': 'URL was judged to be unsafe'}), 400)
 
-    wait = request.json.get('wait', DEFAULT_WAIT)
-    n_screenshots = request.json.get('max_screenshots', DEFAULT_SCREENSHOTS)
-    browser_dim = request.json.get('browser_dim', DEFAULT_BROWSER_DIM)
+    wait = params.get('wait', DEFAULT_WAIT)
+    n_screenshots = params.get('max_screenshots', DEFAULT_SCREENSHOTS)
+    browser_dim = params.get('browser_dim', DEFAULT_BROWSER_DIM)
 
-    if wait < 0 or wait > MAX_WAIT:
-        return jsonify({
+    if not isinstance(wait, (int, float)) or wait < 0 or wait > MAX_WAIT:
+        return None, (jsonify({
             'error': f'Value {wait} for "wait" is unacceptable; must be between 0 and {MAX_WAIT}'
-        }), 400
+        }), 400)
     
+    if not isinstance(browser_dim, list) or len(browser_dim) != 2 or not all(isinstance(x, int) for x in browser_dim):
+        return None, (jsonify({'error': 'browser_dim must be a list of two integers, [width, height]'}), 400)
     for i, name in enumerate(['width', 'height']):
         if browser_dim[i] > MAX_BROWSER_DIM[i] or browser_dim[i] < MIN_BROWSER_DIM[i]:
-            return jsonify({
+            return None, (jsonify({
                 'error': f'Value {browser_dim[i]} for browser {name} is unacceptable; must be between {MIN_BROWSER_DIM[i]} and {MAX_BROWSER_DIM[i]}'
-            }), 400
+            }), 400)
         
-    if n_screenshots > MAX_SCREENSHOTS:
-        return jsonify({
+    if not isinstance(n_screenshots, int) or n_screenshots > MAX_SCREENSHOTS:
+        return None, (jsonify({
                 'error': f'Value {n_screenshots} for max_screenshots is unacceptable; must be below {MAX_SCREENSHOTS}'
-            }), 400
+            }), 400)
     
+    capture_mode = params.get('capture_mode', 'scroll')
+    if capture_mode not in CAPTURE_MODES:
+        return None, (jsonify({
+            'error': f'Value {capture_mode} for capture_mode is unacceptable; must be one of {", ".join(CAPTURE_MODES)}'
+        }), 400)
+
+    readiness = params.get('readiness', 'fixed')
+    if readiness not in READINESS_MODES:
+        return None, (jsonify({
+            'error': f'Value {readiness} for readiness is unacceptable; must be one of {", ".join(READINESS_MODES)}'
+        }), 400)
+
+    block_resource_types = params.get('block_resource_types', DEFAULT_BLOCK_RESOURCE_TYPES)
+    block_domains = params.get('block_domains', [])
+    max_resource_bytes = params.get('max_resource_bytes')
+    if not isinstance(block_resource_types, list) or not all(isinstance(x, str) for x in block_resource_types):
+        return None, (jsonify({'error': 'block_resource_types must be a list of resource types'}), 400)
+    if not isinstance(block_domains, list) or not all(isinstance(x, str) for x in block_domains):
+        return None, (jsonify({'error': 'block_domains must be a list of domains'}), 400)
+    if max_resource_bytes is not None and (not isinstance(max_resource_bytes, int) or max_resource_bytes <= 0 or max_resource_bytes > MAX_RESOURCE_BYTES):
+        return None, (jsonify({
+            'error': f'Value {max_resource_bytes} for max_resource_bytes is unacceptable; must be between 1 and {MAX_RESOURCE_BYTES}'
+        }), 400)
+    filtering = {
+        'block_resource_types': sorted(set(block_resource_types)),
+        'block_domains': sorted(set(d.lower() for d in block_domains)),
+        'block_trackers': bool(params.get('block_trackers', DEFAULT_BLOCK_TRACKERS)),
+        'max_resource_bytes': max_resource_bytes,
+    }
+
+    dedup = params.get('dedup', DEFAULT_DEDUP)
+    if dedup not in DEDUP_MODES:
+        return None, (jsonify({
+            'error': f'Value {dedup} for dedup is unacceptable; must be one of {", ".join(DEDUP_MODES)}'
+        }), 400)
+    dedup_threshold = params.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD)
+    if not isinstance(dedup_threshold, (int, float)) or dedup_threshold < 0 or dedup_threshold > MAX_DEDUP_THRESHOLD:
+        return None, (jsonify({
+            'error': f'Value {dedup_threshold} for dedup_threshold is unacceptable; must be between 0 and {MAX_DEDUP_THRESHOLD}'
+        }), 400)
+
+    max_age = params.get('max_age')
+    no_cache = bool(params.get('no_cache', False))
+    if max_age is not None and (not isinstance(max_age, (int, float)) or max_age < 0):
+        return None, (jsonify({
+            'error': f'Value {max_age} for max_age is unacceptable; must be a number of seconds >= 0'
+        }), 400)
+
     # Determine the image format from the Accept header
     accept_header = request.headers.get('Accept', 'image/jpeg')
     accepted_formats = {
@@ -151,61 +287,382 @@ def scrape():
     image_format = accepted_formats.get(accept_header)
     if not image_format:
         accepted_formats_list = ', '.join(accepted_formats.keys())
-        return jsonify({
+        return None, (jsonify({
             'error': f'Unsupported image format in Accept header ({accept_header}). Supported Accept header values are: {accepted_formats_list}'
-        }), 406
+        }), 406)
+
+    return {
+        'url': url,
+        'wait': wait,
+        'image_format': image_format,
+        'n_screenshots': n_screenshots,
+        'browser_dim': browser_dim,
+        'capture_mode': capture_mode,
+        'readiness': readiness,
+        'filtering': filtering,
+        'dedup': dedup,
+        'dedup_threshold': dedup_threshold,
+        'max_age': max_age,
+        'no_cache': no_cache,
+        'resolved_ips': {host: ips},  # The worker's browser only connects to these
+    }, None
+
+
+@app.route('/scrape', methods=('POST',))
+def scrape():
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+
+    args, arg_error = parse_scrape_args(request.json)
+    if arg_error:
+        return arg_error
+
+    rate_error = check_rate_limit()
+    if rate_error:
+        return rate_error
+
+    if request.json.get('stream'):
+        return scrape_streaming(args)
 
-    content_file = None
     try:
-        status, headers, content_file, screenshot_files, metadata = scrape_task.apply_async(
-            args=[url, wait, image_format, n_screenshots, browser_dim], kwargs={}
-        ).get(timeout=60)  # 60 seconds
-        headers = {str(k).lower(): v for k, v in headers.items()}  # make headers all lowercase (they're case insensitive)
+        body = scrape_chain(**args, owner=get_owner(), priority='interactive').get(timeout=SCRAPE_TIMEOUT)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except MemoryLimitExceeded as e:
+        print(f"Scrape ran out of memory: {e}", file=sys.stderr, flush=True)
+        return jsonify({'error': 'The page used too much memory'}), 500
     except Exception as e:
         # If scrape_in_child uses too much memory, it seems to end up here.
         # however, if exit(0) is called, I find it doesn't.
         print(f"Exception raised from scraping process: {e}", file=sys.stderr, flush=True)
+        return jsonify({
+            'error': "This is a generic error message; sorry about that."
+        }), 500
+
+    return jsonify(body), 200
+
+
+"""
+
+Streaming /scrape (stream=true): a multipart/mixed response whose parts are sent as the worker makes progress (see progress.py).
+
+1. "response": JSON with the page's status and headers, as soon as navigation finishes
+2. "screenshot": each screenshot's bytes as soon as it's encoded (possibly out of order; see the X-Segment-Index header)
+3. "result": the same JSON body as a non-streaming /scrape, with the uploaded URLs, once everything is done; or "error" if the scrape failed
+
+"""
+
+def multipart_part(boundary, content_type, name, data: bytes, filename=None, extra_headers=None):
+    disposition = f'inline; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+    lines = [f"--{boundary}", f"Content-Type: {content_type}", f"Content-Disposition: {disposition}"]
+    lines.extend(f"{k}: {v}" for k, v in (extra_headers or {}).items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8') + data + b"\r\n"
+
+
+def json_part(boundary, name, body):
+    return multipart_part(boundary, 'application/json', name, json.dumps(body).encode('utf-8'))
+
+
+def scrape_streaming(args):
+    job_id = str(uuid.uuid4())
+    pubsub = progress_redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(progress_channel(job_id))  # Before the job is queued, so that no events are missed
+    try:
+        owner = get_owner()
+        result = scrape_chain(**args, owner=owner, priority='interactive', progress=True, job_id=job_id)
+    except AdmissionRejected as e:
+        pubsub.close()
+        return rejected_response(e)
+    except Exception:
+        pubsub.close()
+        raise
+
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        deadline = time.time() + SCRAPE_TIMEOUT
+        sent_response = False
+        try:
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=1)
+                if message is None:
+                    # Cached results are ready without any events; failures might not have published one
+                    if result.ready() or (result.parent is not None and result.parent.failed()):
+                        if result.successful():
+                            body = result.result
+                            if not sent_response:
+                                yield json_part(boundary, 'response', {'status': body['status'], 'headers': body['headers']})
+                            yield json_part(boundary, 'result', body)
+                        else:
+                            yield json_part(boundary, 'error', {'error': "This is a generic error message; sorry about that."})
+                        break
+                    continue
+
+                event = json.loads(message['data'])
+                if event['event'] == 'response':
+                    sent_response = True
+                    yield json_part(boundary, 'response', {'status': event['status'], 'headers': event['headers']})
+                elif event['event'] == 'screenshot':
+                    yield multipart_part(
+                        boundary,
+                        f"image/{event['format']}",
+                        'screenshot',
+                        base64.b64decode(event['data']),
+                        filename=f"{event['index']}.{event['format']}",
+                        extra_headers={'X-Segment-Index': event['index']}
+                    )
+                elif event['event'] == 'result':
+                    yield json_part(boundary, 'result', event['body'])
+                    break
+                elif event['event'] == 'error':
+                    yield json_part(boundary, 'error', {'error': event['error']})
+                    break
+            else:
+                cancel_jobs(owner, [result])  # Stops the scrape too if it's running, so it doesn't keep its page busy
+                yield json_part(boundary, 'error', {'error': 'Timed out'})
+            yield f"--{boundary}--\r\n".encode('utf-8')
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(generate()), content_type=f'multipart/mixed; boundary={boundary}')
+
+
+# A job is done once its result is ready, or once its scrape failed (then finalize_job never runs)
+def job_finished(result):
+    return result.ready() or (result.parent is not None and result.parent.failed())
+
+
+# Stops jobs that are no longer wanted: both tasks of each chain, and bulk jobs still waiting their turn in the fair scheduler
+# Revoking only stops tasks that haven't started; a running scrape sees the cancel flag at its next step (see cancellation.py)
+def cancel_jobs(owner, results):
+    for result in results:
+        result.revoke()
+        if result.parent is not None:
+            result.parent.revoke()
+    try:
+        request_cancel(progress_redis, [result.id for result in results])
+    except Exception as e:
+        print(f"Cancelling running jobs failed: {e}", file=sys.stderr, flush=True)
+    try:
+        fair_scheduler.cancel(owner, [result.id for result in results])  # Also stops counting them as queued
+    except Exception as e:
+        print(f"Cancelling pending jobs failed: {e}", file=sys.stderr, flush=True)
+
+
+@app.route('/scrape/batch', methods=('POST',))
+def scrape_batch():
+    """
+    Scrapes many URLs at once, streaming back one JSON object per line (NDJSON) as each URL finishes.
+
+    Takes {"urls": [...], ...} where each item of urls is either a URL string or an object with its own url, wait, max_screenshots, and browser_dim.
+    Top level wait, max_screenshots, and browser_dim are shared defaults.
+    Each line includes the index of the URL in the request, since lines arrive in completion order.
+    """
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+
+    urls = request.json.get('urls')
+    if not isinstance(urls, list) or not len(urls):
+        return jsonify({'error': 'No URLs provided'}), 400
+    if len(urls) > MAX_BATCH_URLS:
+        return jsonify({'error': f'Too many URLs ({len(urls)}); must be at most {MAX_BATCH_URLS}'}), 400
+    if RATE_LIMIT_PER_MINUTE and len(urls) > RATE_LIMIT_PER_MINUTE:  # Would never fit in the rate limit, so retrying wouldn't help
+        return jsonify({'error': f'Too many URLs ({len(urls)}); must be at most {RATE_LIMIT_PER_MINUTE}, the rate limit per minute'}), 400
+
+    rate_error = check_rate_limit(len(urls))
+    if rate_error:
+        return rate_error
+
+    # Resolve every distinct host concurrently up front, so validating each URL below hits the DNS cache
+    # Only a warm-up: each URL's own validation resolves its host again, so a bad host is an error for that URL alone
+    hosts = set()
+    for item in urls:
+        try:
+            host = urlparse(str(item.get('url', '') if isinstance(item, dict) else item).strip()).hostname
+        except ValueError:
+            continue
+        if host:
+            hosts.add(host)
+    try:
+        dns_resolver.resolve_many(hosts)
+    except Exception as e:
+        print(f"Resolving the batch's hosts up front failed: {e}", file=sys.stderr, flush=True)
+
+    shared = {k: request.json[k] for k in ('wait', 'max_screenshots', 'browser_dim', 'capture_mode', 'readiness', 'block_resource_types', 'block_domains', 'block_trackers', 'max_resource_bytes', 'dedup', 'dedup_threshold', 'max_age', 'no_cache') if k in request.json}
 
-    successful = True if content_file else False
+    owner = get_owner()
 
-    if successful:
+    # Validate every URL before enqueuing any, so that a bad item can't fail the request with jobs already running
+    errors = {}  # index -> error body
+    parsed = {}  # index -> scrape_task arguments
+    for i, item in enumerate(urls):
+        params = {**shared, **(item if isinstance(item, dict) else {'url': item})}
+        try:
+            args, arg_error = parse_scrape_args(params)
+        except Exception as e:  # i.e., a field of the wrong type that the checks don't catch
+            print(f"Batch item {i} is malformed: {e}", file=sys.stderr, flush=True)
+            args, arg_error = None, (jsonify({'error': 'Malformed item'}), 400)
+        if arg_error:
+            resp, code = arg_error
+            if code == 406:  # Accept header applies to the whole batch
+                return arg_error
+            errors[i] = {'index': i, 'url': params.get('url'), 'success': False, **resp.get_json()}
+        else:
+            parsed[i] = args
+
+    # Jobs say when they're done on the batch's channel (see progress.py); subscribed before any is queued, so that none are missed
+    batch_id = str(uuid.uuid4())
+    pubsub = progress_redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(batch_channel(batch_id))
+
+    # The whole batch is enqueued before streaming starts
+    pending = {}  # index -> (url, AsyncResult)
+    try:
+        for i, args in parsed.items():
+            try:
+                pending[i] = (args['url'], scrape_chain(**args, owner=owner, priority='bulk', done_channel=batch_channel(batch_id)))
+            except AdmissionRejected as e:
+                errors[i] = {'index': i, 'url': args['url'], 'success': False, 'error': f'Server is at capacity ({e.reason}); try again later', 'retry_after': e.retry_after}
+    except Exception:
+        cancel_jobs(owner, [result for _, result in pending.values()])  # Nobody would be waiting on them
+        pubsub.close()
+        raise
+
+    indexes = {result.id: i for i, (_, result) in pending.items()}
+
+    def generate():
         try:
-            # 1. Obtenha o nome do seu bucket S3 de uma variável de ambiente
-            bucket_name = os.getenv('S3_BUCKET_NAME')
-            s3_client = boto3.client('s3')
-            uploaded_urls = []
-
-            # 2. Iterar sobre os arquivos de screenshot
-            for i, ss_path in enumerate(screenshot_files):
-                # Gere um nome de arquivo único para o S3
-                import uuid
-                object_name = f"screenshots/{uuid.uuid4()}.png"
-                
-                # Faça o upload do arquivo para o S3
-                s3_client.upload_file(ss_path, bucket_name, object_name)
-                
-                # Construa a URL do objeto e adicione à lista
-                location = s3_client.get_bucket_location(Bucket=bucket_name)['LocationConstraint']
-                url = f"https://{bucket_name}.s3.{location}.amazonaws.com/{object_name}"
-                uploaded_urls.append(url)
-
-                # Apague o arquivo temporário localmente
-                os.remove(ss_path)
-
-            # 3. Retorne uma resposta JSON com as URLs
-            return jsonify({
-                "success": True,
-                "screenshot_urls": uploaded_urls,
-                "metadata": metadata
-            }), 200
-
-        except Exception as e:
-            print(f"Erro ao fazer upload ou retornar URLs: {e}", file=sys.stderr, flush=True)
-            return jsonify({
-                'error': 'Erro no upload para o S3 ou na resposta da API.'
-            }), 500
-
-    else:
+            for body in errors.values():
+                yield json.dumps(body) + "\n"
+
+            deadline = time.time() + BATCH_TIMEOUT
+            next_sweep = 0
+            while len(pending):
+                done = set()
+                # Cached results are ready without publishing anything, and a message can be missed (i.e., if Redis drops the connection)
+                if time.time() >= next_sweep:
+                    done.update(i for i, (_, result) in pending.items() if job_finished(result))
+                    next_sweep = time.time() + BATCH_SWEEP_INTERVAL
+                message = pubsub.get_message(timeout=1) if not len(done) else None
+                if message is not None:
+                    i = indexes.get(json.loads(message['data'])['job_id'])
+                    if i in pending:
+                        done.add(i)
+
+                for i in sorted(done):
+                    url, result = pending.pop(i)
+                    try:
+                        if not result.ready():
+                            raise Exception(f"Scrape failed: {result.parent.result}")
+                        body = {'index': i, 'url': url, **result.get()}
+                    except Exception as e:
+                        print(f"Exception raised from scraping process: {e}", file=sys.stderr, flush=True)
+                        body = {'index': i, 'url': url, 'success': False, 'error': "This is a generic error message; sorry about that."}
+                    yield json.dumps(body) + "\n"
+
+                if time.time() > deadline:
+                    cancel_jobs(owner, [result for _, result in pending.values()])
+                    for i, (url, result) in pending.items():
+                        yield json.dumps({'index': i, 'url': url, 'success': False, 'error': 'Timed out'}) + "\n"
+                    break
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+"""
+
+Async jobs: POST /jobs enqueues a scrape and returns a job id right away; GET /jobs/<id> reports its state and result.
+
+A small record is kept in Redis for each job so that unknown ids can be told apart from pending ones (Celery can't), and so that only the key that submitted a job can read it.
+
+"""
+
+def job_key(job_id):
+    return f"scrapeserv:job:{job_id}"
+
+
+@app.route('/jobs', methods=('POST',))
+def create_job():
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+
+    args, arg_error = parse_scrape_args(request.json)
+    if arg_error:
+        return arg_error
+
+    callback_url = request.json.get('callback_url')
+    if callback_url and not url_is_safe(callback_url):
+        return jsonify({'error': 'Callback URL was judged to be unsafe'}), 400
+
+    priority = request.json.get('priority', 'bulk')
+    if priority not in PRIORITIES:
+        return jsonify({'error': f'Value {priority} for priority is unacceptable; must be one of {", ".join(PRIORITIES)}'}), 400
+
+    rate_error = check_rate_limit()
+    if rate_error:
+        return rate_error
+
+    try:
+        result = scrape_chain(**args, callback_url=callback_url, owner=get_owner(), priority=priority)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    job_id = result.id
+    redis_client.set(job_key(job_id), json.dumps({
+        'owner': get_owner(),
+        'scrape_task_id': result.parent.id if result.parent else job_id,  # No parent if the result came from the cache
+        'url': args['url'],
+        'created': time.time(),
+    }), ex=JOB_RESULT_TTL)
+
+    return jsonify({
+        'job_id': job_id,
+        'state': 'PENDING',
+        'status_url': f"/jobs/{job_id}",
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=('GET',))
+def get_job(job_id):
+    auth_error = check_auth()
+    if auth_error:
+        return auth_error
+
+    record = redis_client.get(job_key(job_id))
+    if record is None:
+        return jsonify({'error': 'Job not found'}), 404
+    record = json.loads(record)
+    if record['owner'] != get_owner():
+        return jsonify({'error': 'Job not found'}), 404
+
+    result = AsyncResult(job_id, app=celery)
+    state = result.state
+    if state == 'SUCCESS':
+        return jsonify(result.result), 200
+
+    # Scraping happens in the first task of the chain; the job id is the last task's
+    if state == 'PENDING':
+        scrape_state = AsyncResult(record['scrape_task_id'], app=celery).state
+        if scrape_state in ('STARTED', 'SUCCESS'):
+            state = 'STARTED'
+        elif scrape_state == 'FAILURE':
+            state = 'FAILURE'
+
+    if state == 'FAILURE':
         return jsonify({
+            'job_id': job_id,
+            'state': state,
+            'success': False,
             'error': "This is a generic error message; sorry about that."
-        }), 500
+        }), 200
+
+    return jsonify({
+        'job_id': job_id,
+        'state': state,
+        'url': record['url'],
+        'created': record['created'],
+    }), 200
@@ -0,0 +1,159 @@
+import tempfile
+import base64
+import time
+import sys
+import os
+
+"""
+
+Artifacts are the outputs of scrape_task (screenshots and the main content) as they're handed to finalize_job.
+
+finalize_job may run on a different machine than scrape_task, so artifacts never refer to local files:
+- Small artifacts are passed inline through the Celery result in Redis (base64 encoded, since results are JSON).
+- Artifacts larger than the spill threshold are uploaded to storage by the worker that made them, and passed by key and URL.
+
+Either way, an artifact is a small JSON-serializable dict:
+- {'inline': <base64 str>, 'size': n}
+- {'stored': <storage key>, 'url': <url>, 'size': n}
+- {'ref': i} for a screenshot that duplicates screenshot i (see dedup.py); it's not uploaded again
+
+Stored artifacts are recorded in Redis until finalize_job claims them. If the job dies in between, nobody would,
+so a sweeper (see ArtifactStore.sweep) deletes stored artifacts that have gone unclaimed for too long.
+
+"""
+
+PENDING_KEY = "scrapeserv:artifacts:pending"  # Sorted set of unclaimed storage keys, scored by when they were stored
+SWEEP_LOCK_KEY = "scrapeserv:artifacts:sweep"
+
+
+def make_ref_artifact(index):
+    return {'ref': index}
+
+
+# Returns the bytes of an inline artifact
+def artifact_source(artifact):
+    return base64.b64decode(artifact['inline'])
+
+
+class ArtifactStore:
+    def __init__(self, get_storage, redis_client, spill_bytes):
+        self.get_storage = get_storage
+        self.redis = redis_client
+        self.spill_bytes = spill_bytes
+
+    def _store(self, source, key, content_type, size):
+        # Recorded before uploading, so that it's swept even if the upload only partly happens
+        self.redis.zadd(PENDING_KEY, {key: time.time()})
+        url = self.get_storage().put(source, key, content_type)
+        return {'stored': key, 'url': url, 'size': size}
+
+    def make(self, data: bytes, key, content_type=None):
+        """
+        key is where the artifact is uploaded if it's too big to pass inline.
+        """
+        if len(data) <= self.spill_bytes:
+            return {'inline': base64.b64encode(data).decode('ascii'), 'size': len(data)}
+        return self._store(data, key, content_type, len(data))
+
+    def make_from_file(self, path, key, content_type=None):
+        """
+        For content that's already on disk (i.e., a download saved by Playwright); the file is removed afterward.
+        """
+        try:
+            size = os.path.getsize(path)
+            if size <= self.spill_bytes:
+                with open(path, 'rb') as fhand:
+                    return self.make(fhand.read(), key, content_type)
+            return self._store(path, key, content_type, size)
+        finally:
+            remove_file(path)
+
+    def writer(self, key, content_type=None):
+        return ArtifactWriter(self, key, content_type)
+
+    def claim(self, artifacts):
+        """
+        Called once a job's result refers to its stored artifacts, so that they're no longer swept.
+        """
+        keys = [a['stored'] for a in artifacts if a and 'stored' in a]
+        if len(keys):
+            try:
+                self.redis.zrem(PENDING_KEY, *keys)
+            except Exception as e:
+                print(f"Claiming artifacts failed: {e}", file=sys.stderr, flush=True)
+
+    def discard(self, artifact):
+        if artifact and 'stored' in artifact:
+            try:
+                self.get_storage().delete(artifact['stored'])
+                self.redis.zrem(PENDING_KEY, artifact['stored'])
+            except Exception as e:
+                print(f"Discarding artifact {artifact['stored']} failed (it'll be swept later): {e}", file=sys.stderr, flush=True)
+
+    def sweep(self, max_age):
+        """
+        Deletes stored artifacts left unclaimed for more than max_age seconds; returns how many.
+        Only one sweep runs at a time across all nodes.
+        """
+        lock = self.redis.lock(SWEEP_LOCK_KEY, timeout=600)
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            swept = 0
+            for key in self.redis.zrangebyscore(PENDING_KEY, '-inf', time.time() - max_age, start=0, num=1000):
+                key = key.decode('utf-8')
+                try:
+                    self.get_storage().delete(key)
+                except Exception as e:
+                    print(f"Sweeping artifact {key} failed: {e}", file=sys.stderr, flush=True)
+                    continue
+                self.redis.zrem(PENDING_KEY, key)
+                swept += 1
+            return swept
+        finally:
+            lock.release()
+
+
+class ArtifactWriter:
+    """
+    Builds an artifact from a stream of chunks, in memory until it grows past the spill threshold and in a local temp file after that.
+    """
+    def __init__(self, store: ArtifactStore, key, content_type=None):
+        self.store = store
+        self.key = key
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.fhand = None
+        self.path = None
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.fhand is None and len(self.buffer) + len(chunk) > self.store.spill_bytes:
+            fd, self.path = tempfile.mkstemp(prefix='scrapeserv-')
+            self.fhand = os.fdopen(fd, 'wb')
+            self.fhand.write(self.buffer)
+            self.buffer = bytearray()
+        if self.fhand is not None:
+            self.fhand.write(chunk)
+        else:
+            self.buffer.extend(chunk)
+
+    def artifact(self):
+        if self.fhand is None:
+            return self.store.make(bytes(self.buffer), self.key, self.content_type)
+        self.fhand.close()
+        return self.store.make_from_file(self.path, self.key, self.content_type)
+
+    # If writing failed partway
+    def discard(self):
+        if self.fhand is not None:
+            self.fhand.close()
+            remove_file(self.path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
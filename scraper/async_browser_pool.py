@@ -0,0 +1,203 @@
+from playwright.async_api import async_playwright, Error as PlaywrightError
+from browser_pool import MemoryLimitExceeded, browser_rss_mb
+import threading
+import asyncio
+import psutil
+import time
+import sys
+import os
+
+"""
+
+The async engine (ENGINE "async" in worker.py): one warm Firefox per worker process, driving many jobs' pages at once.
+
+Most of a scrape is spent waiting on the network or on wait, so a whole process and browser per job leaves both mostly idle.
+With this engine, the worker process runs Celery's thread pool. Each task thread hands its page to an asyncio event loop running in the background and blocks until it's done.
+The loop drives up to max_pages pages concurrently, each in its own browser context (so jobs stay as isolated as with browser_pool.py); more jobs wait for a page.
+
+Each page has its own limits:
+- page_timeout: the page is closed and PageTimeout raised if the job's work with it takes longer than this
+- limit_mb: while the process and its browser use more than this much resident memory, pages are stopped newest first (MemoryLimitExceeded).
+  A browser's memory can't be attributed to its pages, so the newest page goes; older ones are closer to done.
+
+The browser is recycled for the same reasons as in browser_pool.py, but pages still open on the old browser finish first.
+
+"""
+
+class PageTimeout(Exception):
+    pass
+
+
+class AsyncBrowserPool:
+    def __init__(self, max_pages, max_jobs, max_rss_mb, limit_mb, page_timeout, launch_timeout=10_000, firefox_user_prefs=None, guard_interval=0.5, shed_cooldown=2):
+        self.max_pages = max_pages
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.limit_mb = limit_mb
+        self.page_timeout = page_timeout
+        self.launch_timeout = launch_timeout
+        self.firefox_user_prefs = firefox_user_prefs
+        self.guard_interval = guard_interval
+        self.shed_cooldown = shed_cooldown  # Seconds between stopping pages, so that memory freed by one shows before another is stopped
+        self._loop = None
+        self._pid = None  # The process that started the loop (pools don't survive a fork)
+        self._start_lock = threading.Lock()
+        self._playwright = None
+        self._browser = None
+        self._semaphore = None
+        self._launch_lock = None
+        self._pages_on = {}  # Browser -> pages open on it
+        self._retired = set()  # Browsers to close once their last page is done
+        self._running = {}  # Task -> when it got its page
+        self._running_lock = threading.Lock()  # _running is also read by the memory guard's thread
+        self._shed = {}  # Tasks stopped by the memory guard -> MB used at the time
+        self.pages_open = 0
+        self.jobs_served = 0  # By the current browser
+        self.launches = 0
+        self.last_launch_seconds = None
+
+    def _start(self):
+        # Started lazily, so that the loop and browser belong to the worker process
+        with self._start_lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop.run_forever, daemon=True, name='async-browser').start()
+            threading.Thread(target=self._guard, daemon=True, name='memory-guard').start()
+
+    def run(self, capture, **context_kwargs):
+        """
+        Runs capture(context), an async function, with a new browser context; blocks the calling thread until it's done.
+        Returns (capture's result, info about the page's browser for metadata).
+        """
+        self._start()
+        return asyncio.run_coroutine_threadsafe(self._run_page(capture, context_kwargs), self._loop).result()
+
+    async def _run_page(self, capture, context_kwargs):
+        if self._semaphore is None:  # Made here so that they belong to the loop
+            self._semaphore = asyncio.Semaphore(self.max_pages)
+            self._launch_lock = asyncio.Lock()
+        wait_start = time.monotonic()
+        async with self._semaphore:
+            info = {'page_wait_seconds': time.monotonic() - wait_start}
+            browser, warm = await self._get_browser()
+            self.jobs_served += 1
+            info.update({'warm': warm, 'jobs_served': self.jobs_served, 'launch_seconds': None if warm else self.last_launch_seconds})
+            self._pages_on[browser] = self._pages_on.get(browser, 0) + 1
+            self.pages_open += 1
+            info['pages_open'] = self.pages_open  # Including this one
+            task = asyncio.current_task()
+            with self._running_lock:
+                self._running[task] = time.monotonic()
+            context = None
+            try:
+                context_start = time.monotonic()
+                context = await browser.new_context(**context_kwargs)
+                info['context_seconds'] = time.monotonic() - context_start
+                return await asyncio.wait_for(capture(context), self.page_timeout), info
+            except asyncio.TimeoutError as e:
+                raise PageTimeout(f"Page took longer than {self.page_timeout} seconds") from e
+            except asyncio.CancelledError as e:
+                if task in self._shed:
+                    raise MemoryLimitExceeded(f"Worker used {self._shed[task]:.0f} MB, more than the limit of {self.limit_mb} MB; stopped the newest page") from e
+                raise e
+            finally:
+                with self._running_lock:
+                    self._running.pop(task, None)
+                self._shed.pop(task, None)
+                if context is not None:
+                    try:
+                        await context.close()
+                    except PlaywrightError:
+                        pass
+                self._pages_on[browser] -= 1
+                self.pages_open -= 1
+                await self._after_page(browser)
+
+    def _recycle_reason(self):
+        if not self._browser.is_connected():
+            return 'crashed'
+        if self.jobs_served >= self.max_jobs:
+            return 'max_jobs'
+        if browser_rss_mb() >= self.max_rss_mb:
+            return 'max_rss'
+        return None
+
+    async def _after_page(self, browser):
+        if browser is self._browser:
+            reason = self._recycle_reason()
+            if reason:
+                print(f"Recycling browser after {self.jobs_served} jobs (reason: {reason})", file=sys.stderr, flush=True)
+                self._browser = None
+                self._retired.add(browser)
+        if browser in self._retired and self._pages_on[browser] == 0:
+            self._retired.discard(browser)
+            del self._pages_on[browser]
+            await self._close(browser)
+
+    async def _close(self, browser):
+        try:
+            await browser.close()
+        except PlaywrightError:
+            pass
+
+    # Returns (browser, warm)
+    async def _get_browser(self):
+        async with self._launch_lock:  # Pages waiting on a launch all get the one browser
+            if self._browser is not None and self._browser.is_connected():
+                return self._browser, True
+            if self._browser is not None:  # Crashed; closed once its pages have failed
+                if self._pages_on.get(self._browser, 0):
+                    self._retired.add(self._browser)
+                else:
+                    self._pages_on.pop(self._browser, None)
+                    await self._close(self._browser)
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            start = time.monotonic()
+            # Should be resilient to untrusted websites
+            self._browser = await self._playwright.firefox.launch(headless=True, timeout=self.launch_timeout, firefox_user_prefs=self.firefox_user_prefs)
+            self.jobs_served = 0
+            self.launches += 1
+            self.last_launch_seconds = time.monotonic() - start
+            return self._browser, False
+
+    def _guard(self):
+        me = psutil.Process()
+        while True:
+            time.sleep(self.guard_interval)
+            with self._running_lock:
+                running = [(started, task) for task, started in self._running.items() if task not in self._shed]
+            if not len(running):
+                continue
+            used_mb = me.memory_info().rss / (1024 * 1024) + browser_rss_mb()
+            if used_mb <= self.limit_mb:
+                continue
+            _, newest = max(running, key=lambda item: item[0])
+            self._shed[newest] = used_mb
+            print(f"Worker used {used_mb:.0f} MB (limit {self.limit_mb} MB) with {len(running)} pages open; stopping the newest", file=sys.stderr, flush=True)
+            self._loop.call_soon_threadsafe(newest.cancel)
+            time.sleep(self.shed_cooldown)
+
+    def browser_rss_mb(self):
+        return browser_rss_mb()
+
+    async def _shutdown(self):
+        for browser in [self._browser, *self._retired]:
+            if browser is not None:
+                await self._close(browser)
+        self._browser = None
+        self._retired = set()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    def shutdown(self):
+        if self._loop is None or self._pid != os.getpid():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=10)
+        except Exception as e:
+            print(f"Shutting down the async browser pool failed: {e}", file=sys.stderr, flush=True)
+        self._loop.call_soon_threadsafe(self._loop.stop)
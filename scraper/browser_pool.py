@@ -0,0 +1,171 @@
+from playwright.sync_api import sync_playwright, Error as PlaywrightError
+from contextlib import contextmanager
+import threading
+import psutil
+import time
+import sys
+import os
+
+"""
+
+Each Celery worker process keeps one long-lived ("warm") Firefox and hands every job a fresh, isolated browser context.
+
+Launching Firefox is a large part of a scrape's latency and CPU, so the browser is only relaunched when:
+- it has served max_jobs jobs,
+- the browser process tree has grown past max_rss_mb resident memory, or
+- it crashed / disconnected.
+
+Browser contexts don't share cookies, storage, or cache, so jobs remain isolated from each other.
+
+While a job runs, memory_guard() watches the resident memory of the task process and its browser, and kills the browser if it goes over the job's limit.
+(Unlike RLIMIT_AS, that counts memory actually used rather than address space, which Firefox reserves far more of than it needs.)
+
+"""
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+# Resident memory of this process' children (the browser and its content processes), in MB
+def browser_rss_mb():
+    total = 0
+    try:
+        for child in psutil.Process().children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+    except psutil.NoSuchProcess:
+        pass
+    return total / (1024 * 1024)
+
+
+class BrowserPool:
+    def __init__(self, max_jobs, max_rss_mb, launch_timeout=10_000, firefox_user_prefs=None):
+        self.max_jobs = max_jobs
+        self.firefox_user_prefs = firefox_user_prefs
+        self.max_rss_mb = max_rss_mb
+        self.launch_timeout = launch_timeout
+        self._playwright = None
+        self._browser = None
+        self._pid = None  # The process that launched the browser (pools don't survive a fork)
+        self.jobs_served = 0  # By the current browser
+        self.launches = 0
+        self.last_launch_seconds = None  # How long the latest launch took
+
+    def _launch(self):
+        if self._playwright is None or self._pid != os.getpid():
+            self._playwright = sync_playwright().start()
+            self._pid = os.getpid()
+        start = time.monotonic()
+        # Should be resilient to untrusted websites
+        self._browser = self._playwright.firefox.launch(headless=True, timeout=self.launch_timeout, firefox_user_prefs=self.firefox_user_prefs)
+        self.jobs_served = 0
+        self.launches += 1
+        self.last_launch_seconds = time.monotonic() - start
+
+    def _is_alive(self):
+        return (
+            self._browser is not None and
+            self._pid == os.getpid() and
+            self._browser.is_connected()
+        )
+
+    def browser_rss_mb(self):
+        return browser_rss_mb()
+
+    @contextmanager
+    def memory_guard(self, limit_mb, interval=0.5):
+        """
+        Kills the browser if this process and its browser use more than limit_mb resident memory while in the block.
+        Playwright then fails whatever it was doing, and MemoryLimitExceeded is raised instead.
+        """
+        stop = threading.Event()
+        exceeded = []
+
+        def watch():
+            me = psutil.Process()
+            while not stop.wait(interval):
+                used_mb = me.memory_info().rss / (1024 * 1024) + self.browser_rss_mb()
+                if used_mb > limit_mb:
+                    exceeded.append(used_mb)
+                    print(f"Job used {used_mb:.0f} MB (limit {limit_mb} MB); killing the browser", file=sys.stderr, flush=True)
+                    # The direct child is Playwright's driver, which is kept so that the pool can relaunch; the browser is below it
+                    for driver in me.children():
+                        try:
+                            for child in driver.children(recursive=True):
+                                child.kill()
+                        except psutil.NoSuchProcess:
+                            pass
+                    return
+
+        watcher = threading.Thread(target=watch, daemon=True, name='memory-guard')
+        watcher.start()
+        try:
+            yield
+        except Exception as e:
+            if len(exceeded):
+                raise MemoryLimitExceeded(f"Job used {exceeded[0]:.0f} MB, more than the limit of {limit_mb} MB") from e
+            raise e
+        finally:
+            stop.set()
+            watcher.join()
+        if len(exceeded):
+            raise MemoryLimitExceeded(f"Job used {exceeded[0]:.0f} MB, more than the limit of {limit_mb} MB")
+
+    def _recycle_reason(self):
+        if not self._is_alive():
+            return 'crashed'
+        if self.jobs_served >= self.max_jobs:
+            return 'max_jobs'
+        if self.browser_rss_mb() >= self.max_rss_mb:
+            return 'max_rss'
+        return None
+
+    def close_browser(self):
+        if self._browser is not None:
+            try:
+                self._browser.close()
+            except PlaywrightError:
+                pass
+        self._browser = None
+
+    def shutdown(self):
+        self.close_browser()
+        if self._playwright is not None and self._pid == os.getpid():
+            try:
+                self._playwright.stop()
+            except Exception:
+                pass
+        self._playwright = None
+
+    # Returns (browser, warm)
+    def get_browser(self):
+        if self._is_alive():
+            return self._browser, True
+        self.close_browser()
+        self._launch()
+        return self._browser, False
+
+    @contextmanager
+    def new_context(self, **context_kwargs):
+        """
+        Yields (context, warm) where warm says whether the browser was already running before this job.
+        The context is always closed afterward, and the browser is recycled if needed.
+        """
+        browser, warm = self.get_browser()
+        context = None
+        try:
+            context = browser.new_context(**context_kwargs)
+            yield context, warm
+        finally:
+            if context is not None:
+                try:
+                    context.close()
+                except PlaywrightError:
+                    pass
+            self.jobs_served += 1
+            reason = self._recycle_reason()
+            if reason:
+                print(f"Recycling browser after {self.jobs_served} jobs (reason: {reason})", file=sys.stderr, flush=True)
+                self.close_browser()
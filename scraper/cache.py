@@ -0,0 +1,159 @@
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import hashlib
+import json
+import time
+import sys
+import os
+
+"""
+
+Caches final scrape results (the JSON body produced by finalize_job) so that popular URLs aren't re-scraped over and over.
+
+Entries are keyed on the normalized URL plus every capture parameter that changes the result (wait, max_screenshots, browser_dim, image format, capture mode, readiness...).
+
+There are two tiers:
+- Redis (the same instance Celery uses), bounded to max_entries with least-recently-used eviction
+- A directory on disk, bounded to max_disk_mb with least-recently-used eviction (it also survives Redis restarts, since Redis runs without persistence)
+  It's local to each node, so with several worker nodes a hit only happens on the node that cached it; pass disk_dir=None to turn it off.
+
+Both tiers expire entries after ttl seconds. Any failure in the cache is logged and treated as a miss; the cache should never fail a scrape.
+
+"""
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str):
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    if ':' in host:
+        host = f"[{host}]"  # IPv6 literal; hostname drops the brackets
+    port = parsed.port
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f"{host}:{port}"
+    if parsed.username or parsed.password:
+        netloc = f"{parsed.netloc.rsplit('@', 1)[0]}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((scheme, netloc, parsed.path or '/', parsed.params, query, ''))  # Fragment doesn't reach the server
+
+
+# options are scrape_task's keyword arguments (capture_mode, readiness, ...)
+def make_cache_key(url, wait, image_format, n_screenshots, browser_dim, **options):
+    raw = json.dumps([normalize_url(url), wait, image_format, n_screenshots, list(browser_dim), options], sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, redis_client, disk_dir, ttl, max_entries, max_disk_mb):
+        self.redis = redis_client
+        self.disk_dir = disk_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+
+    def _redis_key(self, key):
+        return f"scrapeserv:cache:{key}"
+
+    _lru_key = "scrapeserv:cache:lru"
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key, max_age=None):
+        """
+        Returns (body, age in seconds) or (None, None) on a miss.
+        max_age (seconds) rejects entries older than that, even if they haven't expired.
+        """
+        entry = None
+        try:
+            raw = self.redis.get(self._redis_key(key))
+            if raw is not None:
+                entry = json.loads(raw)
+                self.redis.zadd(self._lru_key, {key: time.time()})
+        except Exception as e:
+            print(f"Cache (redis) get failed: {e}", file=sys.stderr, flush=True)
+
+        if entry is None:
+            entry = self._disk_get(key)
+            if entry is not None:
+                self._redis_put(key, entry)  # Promote
+
+        if entry is None:
+            return None, None
+
+        age = time.time() - entry['created']
+        if age > self.ttl or (max_age is not None and age > max_age):
+            return None, None
+        return entry['body'], age
+
+    def put(self, key, body):
+        entry = {'created': time.time(), 'body': body}
+        self._redis_put(key, entry)
+        self._disk_put(key, entry)
+
+    def _redis_put(self, key, entry):
+        try:
+            remaining = max(int(self.ttl - (time.time() - entry['created'])), 1)
+            pipe = self.redis.pipeline()
+            pipe.set(self._redis_key(key), json.dumps(entry), ex=remaining)
+            pipe.zadd(self._lru_key, {key: time.time()})
+            pipe.execute()
+            excess = self.redis.zcard(self._lru_key) - self.max_entries
+            if excess > 0:
+                evicted = [k.decode('utf-8') if isinstance(k, bytes) else k for k, _ in self.redis.zpopmin(self._lru_key, excess)]
+                self.redis.delete(*[self._redis_key(k) for k in evicted])
+        except Exception as e:
+            print(f"Cache (redis) put failed: {e}", file=sys.stderr, flush=True)
+
+    def _disk_get(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r') as fhand:
+                entry = json.load(fhand)
+            os.utime(path)  # mtime is the LRU clock
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Cache (disk) get failed: {e}", file=sys.stderr, flush=True)
+            return None
+
+    def _disk_put(self, key, entry):
+        if self.disk_dir is None:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as fhand:
+                json.dump(entry, fhand)
+            os.replace(tmp_path, path)  # Atomic, so readers never see a partial entry
+            self._disk_evict()
+        except Exception as e:
+            print(f"Cache (disk) put failed: {e}", file=sys.stderr, flush=True)
+
+    def _disk_evict(self):
+        files = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.disk_dir) as it:
+            for f in it:
+                if not f.name.endswith('.json'):
+                    continue
+                stat = f.stat()
+                if now - stat.st_mtime > self.ttl:  # Not read since it expired
+                    os.remove(f.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, f.path))
+                total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,55 @@
+import time
+import sys
+
+"""
+
+Stopping scrapes that are already running, when nobody wants their result anymore (i.e., a stream or a batch timed out).
+
+Revoking a Celery task only stops it if it hasn't started yet. Revoking with terminate=True would kill the whole worker process, warm browser included,
+and does nothing with the thread pool the async engine runs in. So cancelling is cooperative instead:
+the API server sets a flag in Redis for the job (request_cancel), and scrape_task checks it between stages and screenshots (CancelCheck),
+raising JobCancelled, which closes its page and frees its slot for the next job.
+
+"""
+
+CANCEL_TTL = 60 * 10  # Flags outlive any scrape that could still see them (seconds)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def cancel_key(job_id):
+    return f"scrapeserv:cancel:{job_id}"
+
+
+def request_cancel(redis_client, job_ids, ttl=CANCEL_TTL):
+    if not len(job_ids):
+        return
+    pipe = redis_client.pipeline()
+    for job_id in job_ids:
+        pipe.set(cancel_key(job_id), 1, ex=ttl)
+    pipe.execute()
+
+
+class CancelCheck:
+    def __init__(self, redis_client, job_id, interval=1):
+        self.redis = redis_client
+        self.key = cancel_key(job_id) if job_id else None
+        self.interval = interval  # Redis is asked at most this often (seconds)
+        self._next_check = 0
+
+    def check(self):
+        """
+        Raises JobCancelled if the job has been cancelled.
+        """
+        if self.key is None or time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + self.interval
+        try:
+            cancelled = self.redis.exists(self.key)
+        except Exception as e:
+            print(f"Checking for cancellation failed: {e}", file=sys.stderr, flush=True)
+            return
+        if cancelled:
+            raise JobCancelled("Job was cancelled")
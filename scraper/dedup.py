@@ -0,0 +1,89 @@
+from PIL import Image
+import threading
+
+"""
+
+Drops screenshot segments that add nothing: blank ones, and near duplicates of an earlier segment (repeated footers, empty space below the content, an overlay covering the same area, ...).
+
+Each segment gets a difference hash (dHash) of a small grayscale version of it; two segments whose hashes differ in at most a threshold fraction of bits are duplicates.
+A segment is blank if nearly all of its pixels are the same shade. Blank segments are only dropped once an earlier one has been kept,
+so the first segment is never dropped and a sparse page still gets at least one screenshot.
+
+Checks happen in the encoder threads before encoding, so dropped segments aren't encoded or uploaded either.
+Segments are encoded concurrently and a segment is only compared with earlier ones, so each check waits for the earlier segments' checks.
+
+"""
+
+DEDUP_MODES = ['reference', 'skip', 'off']  # reference: duplicates point at the earlier segment; skip: duplicates are left out
+HASH_SIZE = 16  # dHash of HASH_SIZE x HASH_SIZE bits
+BLANK_TOLERANCE = 2  # Shades within this much of the most common one count as the same
+WAIT_TIMEOUT = 30  # Most a check waits on earlier segments (seconds)
+
+
+def dhash(img: Image.Image, size=HASH_SIZE):
+    small = img.convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def blank_fraction(img: Image.Image):
+    """
+    Fraction of pixels within BLANK_TOLERANCE of the most common shade of gray.
+    """
+    histogram = img.convert('L').histogram()
+    peak = max(range(256), key=lambda i: histogram[i])
+    same = sum(histogram[max(peak - BLANK_TOLERANCE, 0):peak + BLANK_TOLERANCE + 1])
+    return same / max(sum(histogram), 1)
+
+
+class SegmentDeduper:
+    """
+    One per scrape; shared by the encoder tasks for its segments.
+    """
+    def __init__(self, threshold, blank_ratio):
+        self.max_distance = round(threshold * HASH_SIZE * HASH_SIZE)
+        self.blank_ratio = blank_ratio
+        self._kept = []  # (segment index, hash) of segments kept so far
+        self._checked = set()
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def check(self, index, img: Image.Image):
+        """
+        Returns None to keep the segment, 'blank', or the index of the earlier segment it duplicates.
+        """
+        blank = blank_fraction(img) >= self.blank_ratio
+        fingerprint = dhash(img)
+        with self._cond:
+            self._cond.wait_for(lambda: self._aborted or all(i in self._checked for i in range(index)), timeout=WAIT_TIMEOUT)
+            try:
+                if blank and index != 0 and len(self._kept):
+                    return 'blank'
+                for earlier, earlier_fingerprint in self._kept:
+                    if bin(fingerprint ^ earlier_fingerprint).count('1') <= self.max_distance:
+                        return earlier
+                self._kept.append((index, fingerprint))
+                return None
+            finally:
+                self._checked.add(index)
+                self._cond.notify_all()
+
+    def _done(self, index):
+        with self._cond:
+            self._checked.add(index)
+            self._cond.notify_all()
+
+    # For segments that won't be checked after all (i.e., encoding failed), so later ones don't wait on them
+    def skip(self, index):
+        self._done(index)
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
@@ -0,0 +1,134 @@
+import socketserver
+import threading
+import selectors
+import socket
+import sys
+
+"""
+
+A small HTTP proxy that every browser context sends its traffic through (see scrape_task in worker.py).
+
+It resolves hosts with the worker's SafeResolver, which has been seeded with the IPs the API server validated,
+and only ever connects to public IPs. This closes the gap between the API's SSRF check and the browser's own DNS lookup,
+and it applies the same check to redirects and subresources.
+
+HTTPS goes through CONNECT tunnels, so the proxy never sees decrypted traffic. Plain HTTP requests are forwarded with Connection: close.
+
+"""
+
+MAX_HEADER_BYTES = 64 * 1024
+RELAY_CHUNK = 64 * 1024
+
+
+class EgressProxyHandler(socketserver.BaseRequestHandler):
+    def _read_head(self):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = self.request.recv(RELAY_CHUNK)
+            if not chunk:
+                return None, None
+            data += chunk
+            if len(data) > MAX_HEADER_BYTES:
+                return None, None
+        head, rest = data.split(b"\r\n\r\n", 1)
+        return head, rest
+
+    def _refuse(self, reason):
+        print(f"Egress proxy refused: {reason}", file=sys.stderr, flush=True)
+        try:
+            self.request.sendall(b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except OSError:
+            pass
+
+    def _connect(self, host, port):
+        ips, reason = self.server.resolver.resolve_safe(host)
+        if ips is None:
+            self._refuse(reason)
+            return None
+        for ip in ips:
+            try:
+                return socket.create_connection((ip, port), timeout=self.server.connect_timeout)
+            except OSError:
+                continue
+        self._refuse(f"could not connect to {host}:{port}")
+        return None
+
+    def _relay(self, upstream):
+        sel = selectors.DefaultSelector()
+        sel.register(self.request, selectors.EVENT_READ, upstream)
+        sel.register(upstream, selectors.EVENT_READ, self.request)
+        try:
+            while True:
+                events = sel.select(timeout=self.server.idle_timeout)
+                if not events:
+                    return
+                for key, _ in events:
+                    data = key.fileobj.recv(RELAY_CHUNK)
+                    if not data:
+                        return
+                    key.data.sendall(data)
+        except OSError:
+            return
+        finally:
+            sel.close()
+            upstream.close()
+
+    def handle(self):
+        self.request.settimeout(self.server.idle_timeout)
+        try:
+            head, rest = self._read_head()
+        except OSError:
+            return
+        if head is None:
+            return
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            return
+
+        if method.upper() == 'CONNECT':
+            host, _, port = target.rpartition(':')
+            upstream = self._connect(host, int(port or 443))
+            if upstream is None:
+                return
+            self.request.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+            if rest:
+                upstream.sendall(rest)
+            self._relay(upstream)
+            return
+
+        # Plain HTTP: target is an absolute URL
+        if not target.lower().startswith('http://'):
+            self._refuse(f"unsupported request target {target}")
+            return
+        hostport, _, path = target[len('http://'):].partition('/')
+        host, _, port = hostport.rpartition(':') if ':' in hostport.split(']')[-1] else (hostport, None, None)
+        upstream = self._connect(host, int(port or 80))
+        if upstream is None:
+            return
+        headers = [
+            line for line in lines[1:]
+            if line.split(':', 1)[0].strip().lower() not in ('proxy-connection', 'connection', 'keep-alive', 'proxy-authorization')
+        ]
+        request_head = "\r\n".join([f"{method} /{path} {version}", *headers, "Connection: close"]) + "\r\n\r\n"
+        upstream.sendall(request_head.encode('latin-1') + rest)
+        self._relay(upstream)
+
+
+class EgressProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, resolver, connect_timeout=10, idle_timeout=60):
+        self.resolver = resolver
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        super().__init__(('127.0.0.1', 0), EgressProxyHandler)  # Any free port, only reachable locally
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name='egress-proxy').start()
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import io
+
+"""
+
+Screenshot encoding runs on a small thread pool in each worker process, separate from the browser.
+
+Each segment is submitted as soon as it's captured, so encoding overlaps with scrolling and capturing the next one,
+and the task's slot is freed soon after the last capture rather than after a serial encoding pass.
+
+With a deduper (see dedup.py), duplicate segments are dropped here before they're encoded, and blank ones after encoding (to measure them) but before upload.
+
+Threads rather than processes: Celery's prefork children are daemonic and can't start their own process pool,
+and Pillow releases the GIL while decoding and encoding, so threads do encode in parallel.
+
+"""
+
+class ScreenshotEncoder:
+    def __init__(self, threads):
+        self.threads = threads
+        self._executor = None
+
+    @property
+    def executor(self):
+        # Made lazily so that the threads belong to the worker process, not the parent that forked it
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='encoder')
+        return self._executor
+
+    def submit(self, raw: bytes, image_format, quality, deduper=None, index=None):
+        """
+        Returns a future resolving to (encoded bytes, {'original': n, 'compressed': n}).
+        If the deduper drops the segment, encoded bytes is None and sizes has 'dedup' ('blank' or {'duplicate_of': earlier segment index}).
+        """
+        return self.executor.submit(encode_screenshot, raw, image_format, quality, deduper, index)
+
+    def submit_slices(self, raw: bytes, offsets, segment_height, image_format, quality, deduper=None, first_index=None):
+        """
+        For one tall capture that covers several segments (capture_mode "fullpage").
+        Returns a future resolving to a list of (encoded bytes, sizes), one per offset.
+        """
+        return self.executor.submit(encode_slices, raw, offsets, segment_height, image_format, quality, deduper, first_index)
+
+
+def check_duplicate(img, raw_size, deduper, index, image_format, quality):
+    """
+    Returns (None, sizes) if the deduper drops the segment, otherwise None.
+    A blank segment is still encoded (which is quick, since it's flat) so that its compressed size counts toward the bytes saved.
+    """
+    if deduper is None:
+        return None
+    decision = deduper.check(index, img)
+    if decision is None:
+        return None
+    compressed = 0
+    if decision == 'blank':
+        buffer = io.BytesIO()
+        img.save(buffer, image_format.upper(), quality=quality)
+        compressed = buffer.tell()
+    return None, {
+        'original': raw_size,
+        'compressed': compressed,
+        'dedup': decision if decision == 'blank' else {'duplicate_of': decision}
+    }
+
+
+def encode_screenshot(raw: bytes, image_format, quality, deduper=None, index=None):
+    buffer = io.BytesIO()
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if img.mode == 'RGBA':  # Will throw an error unless converted
+                img = img.convert('RGB')
+            dropped = check_duplicate(img, len(raw), deduper, index, image_format, quality)
+            if dropped:
+                return dropped
+            img.save(buffer, image_format.upper(), quality=quality)
+    except Exception as e:
+        if deduper:
+            deduper.skip(index)
+        raise e
+    return buffer.getvalue(), {
+        'original': len(raw),
+        'compressed': buffer.tell()
+    }
+
+
+# Crops segments starting at each offset (in pixels from the top of raw) and encodes each one
+# There's no per-segment PNG, so a segment's "original" size is its share of the capture's PNG
+def encode_slices(raw: bytes, offsets, segment_height, image_format, quality, deduper=None, first_index=None):
+    results = []
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if img.mode == 'RGBA':  # Will throw an error unless converted
+                img = img.convert('RGB')
+            for i, offset in enumerate(offsets):
+                segment = img.crop((0, offset, img.width, min(offset + segment_height, img.height)))
+                original = round(len(raw) * segment_height / img.height)
+                dropped = check_duplicate(segment, original, deduper, None if first_index is None else first_index + i, image_format, quality)
+                if dropped:
+                    results.append(dropped)
+                    continue
+                buffer = io.BytesIO()
+                segment.save(buffer, image_format.upper(), quality=quality)
+                results.append((buffer.getvalue(), {
+                    'original': original,
+                    'compressed': buffer.tell()
+                }))
+    except Exception as e:
+        if deduper:
+            for i in range(len(offsets)):
+                deduper.skip(first_index + i)
+        raise e
+    return results
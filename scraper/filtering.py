@@ -0,0 +1,142 @@
+from playwright.sync_api import Error as PlaywrightError
+from urllib.parse import urlparse
+import sys
+import os
+
+"""
+
+Blocks requests that slow page loads down without changing what the page is about (trackers, ads, video, ...).
+
+Rules (see scrape_task's filtering argument):
+- block_resource_types: Playwright resource types to block, like "media" or "font"
+- block_domains: domains to block (subdomains included)
+- block_trackers: also block the domains in blocklist.txt, which is loaded once per worker process
+- max_resource_bytes: subresources that declare a size (Content-Length) bigger than this are dropped. Sizes are asked for with a HEAD request before the browser loads them,
+  which adds a round trip per image, video, font, ..., so it's off unless set. Resources that don't declare a size are loaded.
+
+The page's main document is never blocked.
+With no rules, nothing is routed. Any rule sends every request through a Python handler and turns off the browser's HTTP cache for the context, which costs more than it saves on many pages, so filtering is off unless a user asks for it.
+Routing works the same with Playwright's sync and async APIs; the handlers share the decisions and differ only in the calls to the route (install and install_async).
+
+"""
+
+BLOCKLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocklist.txt')
+SIZE_CHECKED_TYPES = {'image', 'media', 'font', 'other'}  # Other types are small or needed for the page to work
+
+_blocklist = None
+
+def get_blocklist():
+    global _blocklist
+    if _blocklist is None:
+        try:
+            with open(BLOCKLIST_PATH, 'r') as fhand:
+                _blocklist = frozenset(
+                    line.strip().lower() for line in fhand
+                    if line.strip() and not line.startswith('#')
+                )
+        except OSError as e:
+            print(f"Could not load blocklist: {e}", file=sys.stderr, flush=True)
+            _blocklist = frozenset()
+    return _blocklist
+
+
+# True if host or any of its parent domains is in domains
+def domain_matches(host, domains):
+    labels = host.lower().split('.')
+    return any('.'.join(labels[i:]) in domains for i in range(len(labels)))
+
+
+class ResourceFilter:
+    def __init__(self, block_resource_types=(), block_domains=(), block_trackers=False, max_resource_bytes=None):
+        self.block_resource_types = set(block_resource_types)
+        self.block_domains = frozenset(d.lower() for d in block_domains)
+        if block_trackers:
+            self.block_domains = self.block_domains | get_blocklist()
+        self.max_resource_bytes = max_resource_bytes
+        self.stats = {
+            'blocked_requests': 0,
+            'blocked_by': {'resource_type': 0, 'domain': 0, 'size': 0},
+            'blocked_bytes': 0,  # Declared sizes of the requests blocked by size, which were never downloaded; unknown for the others
+        }
+
+    def is_active(self):
+        return bool(self.block_resource_types or self.block_domains or self.max_resource_bytes)
+
+    def install(self, context):
+        if self.is_active():
+            context.route("**/*", self._handle_route)
+
+    # For contexts from Playwright's async API (see async_browser_pool.py)
+    async def install_async(self, context):
+        if self.is_active():
+            await context.route("**/*", self._handle_route_async)
+
+    def _count(self, reason, nbytes=0):
+        self.stats['blocked_requests'] += 1
+        self.stats['blocked_by'][reason] += 1
+        self.stats['blocked_bytes'] += nbytes
+
+    def _verdict(self, request):
+        """
+        Returns 'continue', 'abort' (already counted), or 'check_size' if it's blocked only if it's too big.
+        """
+        resource_type = request.resource_type
+        if resource_type == 'document' and request.frame.parent_frame is None:
+            return 'continue'  # Main document
+
+        if resource_type in self.block_resource_types:
+            self._count('resource_type')
+            return 'abort'
+
+        host = urlparse(request.url).hostname or ''
+        if self.block_domains and domain_matches(host, self.block_domains):
+            self._count('domain')
+            return 'abort'
+
+        if self.max_resource_bytes and resource_type in SIZE_CHECKED_TYPES:
+            return 'check_size'
+        return 'continue'
+
+    # For the response to a HEAD request (None if it failed): 'abort' (counted) if it declares a size that's too big, otherwise 'continue'
+    def _size_verdict(self, head):
+        declared = head.headers.get('content-length', '') if head is not None else ''
+        if declared.isdigit() and int(declared) > self.max_resource_bytes:
+            self._count('size', int(declared))
+            return 'abort'
+        return 'continue'
+
+    def _handle_route(self, route, request):
+        try:
+            verdict = self._verdict(request)
+            if verdict == 'check_size':
+                try:
+                    head = route.fetch(method='HEAD')
+                except PlaywrightError:
+                    head = None  # Size unknown; the request goes ahead
+                verdict = self._size_verdict(head)
+
+            if verdict == 'continue':
+                route.continue_()
+            else:
+                route.abort('blockedbyclient')
+        except PlaywrightError as e:
+            # The page may have navigated away or closed; nothing left to route
+            print(f"Resource filter error for {request.url}: {e}", file=sys.stderr, flush=True)
+
+    # The same with Playwright's async API; only the calls to the route differ
+    async def _handle_route_async(self, route, request):
+        try:
+            verdict = self._verdict(request)
+            if verdict == 'check_size':
+                try:
+                    head = await route.fetch(method='HEAD')
+                except PlaywrightError:
+                    head = None
+                verdict = self._size_verdict(head)
+
+            if verdict == 'continue':
+                await route.continue_()
+            else:
+                await route.abort('blockedbyclient')
+        except PlaywrightError as e:
+            print(f"Resource filter error for {request.url}: {e}", file=sys.stderr, flush=True)
@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+import json
+import time
+import sys
+import os
+
+"""
+
+Counters, histograms, and gauges shared by the API server and every Celery worker process, kept in Redis so that /metrics can aggregate them.
+
+Each task collects its observations in memory (a MetricsBatch) and flushes them in one round trip when it's done.
+Gauges are per process and expire, so processes that die stop being counted.
+
+/metrics renders everything in the Prometheus text format.
+
+"""
+
+PREFIX = "scrapeserv:metrics"
+# Histogram buckets for stage durations (seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60]
+
+HELP = {
+    'scrapeserv_stage_seconds': ('histogram', 'Time spent in each stage of a scrape'),
+    'scrapeserv_request_seconds': ('histogram', 'API request latency by endpoint'),
+    'scrapeserv_jobs_total': ('counter', 'Scrape jobs by outcome'),
+    'scrapeserv_errors_total': ('counter', 'Errors by stage and exception class'),
+    'scrapeserv_bytes_total': ('counter', 'Bytes captured, encoded, and uploaded'),
+    'scrapeserv_cache_total': ('counter', 'Result cache lookups by result'),
+    'scrapeserv_browser_launches_total': ('counter', 'Browser launches (cold starts)'),
+    'scrapeserv_active_tasks': ('gauge', 'Scrape tasks currently running'),
+    'scrapeserv_worker_rss_bytes': ('gauge', 'Resident memory of each worker process, including its browser'),
+    'scrapeserv_queue_depth': ('gauge', 'Tasks waiting in each Celery queue'),
+    'scrapeserv_key_queue_depth': ('gauge', 'Scrapes submitted but not yet started, by API key and priority'),
+    'scrapeserv_queue_wait_seconds': ('histogram', 'Time from submitting a scrape to it starting, by API key and priority'),
+    'scrapeserv_rate_limited_total': ('counter', 'Scrapes turned away by the per-key rate limit'),
+}
+
+
+def _field(name, labels):
+    return f"{name}|{json.dumps(labels or {}, sort_keys=True)}"
+
+
+def _parse_field(field):
+    name, _, labels = field.partition('|')
+    return name, json.loads(labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + inner + "}"
+
+
+class MetricsBatch:
+    """
+    Observations made during one task or request, written to Redis together by flush().
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.counters = {}
+        self.observations = []
+
+    def inc(self, name, value=1, labels=None):
+        key = _field(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        self.observations.append((name, value, labels))
+
+    def flush(self):
+        self.metrics.write(self.counters, self.observations)
+        self.counters = {}
+        self.observations = []
+
+
+class StageTimings:
+    """
+    Times the stages of one scrape, both for the per-request timings in metadata and for the stage histogram.
+    """
+    def __init__(self, batch):
+        self.batch = batch
+        self.timings = {}
+
+    def add(self, stage, seconds):
+        self.timings[stage] = round(self.timings.get(stage, 0) + seconds, 4)
+        self.batch.observe('scrapeserv_stage_seconds', seconds, {'stage': stage})
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+
+class Metrics:
+    def __init__(self, redis_client, gauge_ttl=300):
+        self.redis = redis_client
+        self.gauge_ttl = gauge_ttl
+
+    def batch(self):
+        return MetricsBatch(self)
+
+    def write(self, counters, observations):
+        try:
+            pipe = self.redis.pipeline()
+            for key, value in counters.items():
+                pipe.hincrbyfloat(f"{PREFIX}:counters", key, value)
+            for name, value, labels in observations:
+                for bucket in BUCKETS:
+                    if value <= bucket:
+                        pipe.hincrby(f"{PREFIX}:hist", _field(name, {**(labels or {}), 'le': bucket}), 1)
+                pipe.hincrby(f"{PREFIX}:hist", _field(name, {**(labels or {}), 'le': '+Inf'}), 1)
+                pipe.hincrbyfloat(f"{PREFIX}:hist_sum", _field(name, labels), value)
+            pipe.execute()
+        except Exception as e:
+            print(f"Writing metrics failed: {e}", file=sys.stderr, flush=True)
+
+    def set_gauge(self, name, value, labels=None):
+        """
+        Sets this process' value for a gauge; values from every live process are summed in /metrics.
+        """
+        try:
+            labels = {**(labels or {}), 'pid': os.getpid()}
+            self.redis.hset(f"{PREFIX}:gauges", _field(name, labels), json.dumps({'value': value, 'expires': time.time() + self.gauge_ttl}))
+        except Exception as e:
+            print(f"Writing metrics failed: {e}", file=sys.stderr, flush=True)
+
+    def render(self, extra_gauges=None):
+        """
+        Returns every metric in the Prometheus text format.
+        extra_gauges are (name, value, labels) computed at scrape time (like queue depth).
+        """
+        lines = {}  # name -> list of lines
+
+        def emit(name, line):
+            lines.setdefault(name, []).append(line)
+
+        for field, value in self.redis.hgetall(f"{PREFIX}:counters").items():
+            name, labels = _parse_field(field.decode('utf-8'))
+            emit(name, f"{name}{_format_labels(labels)} {float(value)}")
+
+        hist_sums = {}
+        for field, value in self.redis.hgetall(f"{PREFIX}:hist_sum").items():
+            hist_sums[field.decode('utf-8')] = float(value)
+        buckets = {}
+        for field, value in self.redis.hgetall(f"{PREFIX}:hist").items():
+            name, labels = _parse_field(field.decode('utf-8'))
+            le = labels.pop('le')
+            buckets.setdefault(_field(name, labels), {})[str(le)] = int(value)
+        for key, series in sorted(buckets.items()):
+            name, labels = _parse_field(key)
+            for le in [*BUCKETS, '+Inf']:  # Buckets below every observation were never written
+                emit(name, f"{name}_bucket{_format_labels({**labels, 'le': le})} {series.get(str(le), 0)}")
+            emit(name, f"{name}_count{_format_labels(labels)} {series.get('+Inf', 0)}")
+            emit(name, f"{name}_sum{_format_labels(labels)} {hist_sums.get(key, 0)}")
+
+        # Gauges are summed across live processes (the pid label is dropped), and expired ones are cleaned up
+        now = time.time()
+        gauges = {}
+        expired = []
+        for field, raw in self.redis.hgetall(f"{PREFIX}:gauges").items():
+            entry = json.loads(raw)
+            if entry['expires'] < now:
+                expired.append(field)
+                continue
+            name, labels = _parse_field(field.decode('utf-8'))
+            labels.pop('pid', None)
+            key = _field(name, labels)
+            gauges[key] = gauges.get(key, 0) + entry['value']
+        if len(expired):
+            self.redis.hdel(f"{PREFIX}:gauges", *expired)
+        for name, value, labels in (extra_gauges or []):
+            gauges[_field(name, labels)] = value
+        for key, value in gauges.items():
+            name, labels = _parse_field(key)
+            emit(name, f"{name}{_format_labels(labels)} {value}")
+
+        out = []
+        for name in sorted(lines):
+            kind, help_text = HELP.get(name, ('untyped', ''))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines[name])
+        return "\n".join(out) + "\n"
@@ -0,0 +1,141 @@
+import threading
+import urllib3
+import socket
+import sys
+
+"""
+
+The browserless fast path: a plain HTTP request made before launching anything, to see what the URL actually is.
+
+If it isn't an HTML page (a PDF, an image, JSON, ...), its body is streamed to an artifact and the browser is skipped entirely,
+which is much cheaper than a page render (and avoids Playwright's "Download is starting" dance).
+HTML pages, and anything that isn't a success, go on to the browser as before; the preflight only reads their headers.
+
+Bodies are capped in size and in total time (the request's timeout only applies to each read), and fail the job with PreflightFailed past either.
+A redirect still left after max_redirects fails it too, rather than being taken as the content.
+
+Requests go through the worker's egress proxy, so they get the same SSRF checks as the browser, including on every redirect.
+Connections are pooled per worker process.
+
+"""
+
+class PreflightFailed(Exception):
+    pass
+
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+CHUNK_BYTES = 64 * 1024
+
+
+def is_html(content_type):
+    mime_type = content_type.split(';')[0].strip().lower()
+    return mime_type in HTML_TYPES or mime_type == ''  # Without a type, let the browser figure it out
+
+
+class Preflight:
+    def __init__(self, get_proxy_url, user_agent, timeout, max_redirects, pool_size=4):
+        self.get_proxy_url = get_proxy_url
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.pool_size = pool_size
+        self._manager = None
+
+    @property
+    def manager(self):
+        # Made lazily, like the egress proxy it points at, so that it belongs to the worker process
+        if self._manager is None:
+            self._manager = urllib3.ProxyManager(
+                self.get_proxy_url(),
+                num_pools=50,
+                maxsize=self.pool_size,
+                headers={'User-Agent': self.user_agent}
+            )
+        return self._manager
+
+    def fetch(self, url):
+        """
+        Returns the final response after redirects, with its body not yet read, or None if the request failed.
+        Read it with stream_body() or let it go with close().
+        Raises PreflightFailed if there are still redirects after max_redirects.
+        """
+        try:
+            response = self.manager.request(
+                'GET',
+                url,
+                preload_content=False,
+                redirect=True,
+                retries=urllib3.Retry(total=self.max_redirects, redirect=self.max_redirects, connect=0, read=0, raise_on_redirect=False),
+                timeout=urllib3.Timeout(connect=self.timeout, read=self.timeout),
+            )
+        except urllib3.exceptions.HTTPError as e:
+            print(f"Preflight request for {url} failed (falling back to the browser): {e}", file=sys.stderr, flush=True)
+            return None
+        if 300 <= response.status < 400:
+            close(response)
+            raise PreflightFailed(f"More than {self.max_redirects} redirects")
+        return response
+
+
+def stream_body(response, write, max_bytes, deadline):
+    """
+    Passes the (decompressed) body to write in chunks; returns the number of bytes.
+    Raises PreflightFailed if the body is bigger than max_bytes or takes more than deadline seconds.
+    """
+    declared = response.headers.get('Content-Length', '')
+    if declared.isdigit() and int(declared) > max_bytes:
+        close(response)
+        raise PreflightFailed(f"Body is {declared} bytes, more than the limit of {max_bytes}")
+
+    # A read blocks for as long as data keeps trickling in, so the deadline cuts the connection from another thread
+    expired = threading.Event()
+    def expire():
+        expired.set()
+        abort(response)
+    timer = threading.Timer(deadline, expire)
+    timer.daemon = True
+    timer.start()
+
+    total = 0
+    finished = False
+    try:
+        for chunk in response.stream(CHUNK_BYTES):
+            total += len(chunk)
+            if total > max_bytes:
+                raise PreflightFailed(f"Body is more than the limit of {max_bytes} bytes")
+            write(chunk)
+        if expired.is_set():  # Cut off, which can look like the end of the body
+            raise PreflightFailed(f"Body took more than {deadline} seconds")
+        finished = True
+    except (urllib3.exceptions.HTTPError, OSError) as e:
+        if expired.is_set():
+            raise PreflightFailed(f"Body took more than {deadline} seconds") from e
+        raise e
+    finally:
+        timer.cancel()
+        if finished:
+            response.release_conn()
+        else:
+            close(response)
+    return total
+
+
+def abort(response):
+    # Shuts down the response's socket, which wakes up a read blocked on it.
+    # Found through its file descriptor: the connection has already let go of it when the server closes after the response
+    try:
+        sock = socket.fromfd(response.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    except (OSError, ValueError):
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()  # Only the duplicate made by fromfd
+
+
+def close(response):
+    # The body isn't wanted; closing is cheaper than reading it just to reuse the connection
+    response.close()
+    response.release_conn()
@@ -0,0 +1,49 @@
+import base64
+import json
+import sys
+
+"""
+
+Progress of a scrape, published by the worker over Redis pub/sub so that /scrape can stream results as they're ready (see stream=true in app.py).
+
+Events on a job's channel, in order:
+- response: the status and headers of the page, right after navigation
+- screenshot: one encoded screenshot (base64), as soon as it's encoded; these can arrive out of order, so each has its index
+- result: the job's final JSON body (with the uploaded URLs), or error if it failed
+
+Pub/sub doesn't keep messages, so the API server subscribes before the job is queued.
+
+/scrape/batch listens on one channel for the whole batch instead, where each job only publishes that it's done (see publish_done).
+
+"""
+
+def progress_channel(job_id):
+    return f"scrapeserv:progress:{job_id}"
+
+
+def batch_channel(batch_id):
+    return f"scrapeserv:batch:{batch_id}"
+
+
+def publish_done(redis_client, channel, job_id):
+    try:
+        redis_client.publish(channel, json.dumps({'event': 'done', 'job_id': job_id}))
+    except Exception as e:
+        print(f"Publishing progress failed: {e}", file=sys.stderr, flush=True)
+
+
+class ProgressPublisher:
+    def __init__(self, redis_client, job_id):
+        self.redis = redis_client
+        self.channel = progress_channel(job_id) if job_id else None  # No job id means nobody is listening
+
+    def publish(self, event, **data):
+        if self.channel is None:
+            return
+        try:
+            self.redis.publish(self.channel, json.dumps({'event': event, **data}))
+        except Exception as e:
+            print(f"Publishing progress failed: {e}", file=sys.stderr, flush=True)
+
+    def publish_screenshot(self, index, encoded, image_format, sizes):
+        self.publish('screenshot', index=index, format=image_format, sizes=sizes, data=base64.b64encode(encoded).decode('ascii'))
@@ -0,0 +1,130 @@
+import time
+
+"""
+
+Decides when a page is ready to be captured, rather than always sleeping for the full wait.
+
+With readiness "adaptive", a wait ends as soon as all of these hold, with wait as the upper bound:
+- no network requests have been in flight for quiet_ms (long-lived connections like websockets don't count)
+- the DOM hasn't been mutated for quiet_ms
+- fonts have loaded
+- images in the viewport have finished loading
+
+Quiet periods are measured from the start of each wait, so lazy-loaded content that a scroll triggers gets a chance to start loading.
+With readiness "fixed", a wait is simply a sleep for the full wait.
+
+AsyncReadinessWatcher does the same for pages from Playwright's async API (see async_browser_pool.py); the two share everything but the calls to the page.
+
+"""
+
+READINESS_MODES = ['fixed', 'adaptive']
+
+# Installed before any of the page's scripts run
+MUTATION_TRACKER_JS = """
+(() => {
+    window.__scrapeservLastMutation = performance.now();
+    const observe = () => {
+        new MutationObserver(() => { window.__scrapeservLastMutation = performance.now(); })
+            .observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+    };
+    if (document.documentElement) observe();
+    else document.addEventListener('DOMContentLoaded', observe);
+})();
+"""
+
+READY_CHECK_JS = """
+() => {
+    const quietMs = performance.now() - (window.__scrapeservLastMutation || 0);
+    const fontsReady = !document.fonts || document.fonts.status === 'loaded';
+    const visibleImages = Array.from(document.images).filter(img => {
+        const r = img.getBoundingClientRect();
+        return r.width > 0 && r.height > 0 && r.bottom > 0 && r.top < window.innerHeight;
+    });
+    const imagesReady = visibleImages.every(img => img.complete);
+    return {quietMs, fontsReady, imagesReady};
+}
+"""
+
+IGNORED_RESOURCE_TYPES = {'websocket', 'eventsource'}
+
+
+class ReadinessWatcher:
+    """
+    Call install() before navigating.
+    """
+    def __init__(self, page, mode, quiet_ms, poll_ms):
+        self.page = page
+        self.mode = mode
+        self.quiet_ms = quiet_ms
+        self.poll_ms = poll_ms
+        self._inflight = set()
+        self._last_network_activity = time.monotonic()
+
+    def install(self):
+        if self.mode == 'adaptive':
+            self.page.add_init_script(MUTATION_TRACKER_JS)
+            self._listen()
+
+    def _listen(self):
+        self.page.on("request", self._on_request_start)
+        self.page.on("requestfinished", self._on_request_end)
+        self.page.on("requestfailed", self._on_request_end)
+
+    def _on_request_start(self, request):
+        if request.resource_type in IGNORED_RESOURCE_TYPES:
+            return
+        self._inflight.add(request)
+        self._last_network_activity = time.monotonic()
+
+    def _on_request_end(self, request):
+        self._inflight.discard(request)
+        self._last_network_activity = time.monotonic()
+
+    # How long to sleep before each check, until max_wait_ms is up
+    def _polls(self, start, max_wait_ms):
+        while (time.monotonic() - start) * 1000 < max_wait_ms:
+            remaining_ms = max_wait_ms - (time.monotonic() - start) * 1000
+            yield min(self.poll_ms, remaining_ms)
+
+    # Checked before asking the page, which costs a round trip
+    def _network_quiet(self, start):
+        network_quiet_ms = (time.monotonic() - max(self._last_network_activity, start)) * 1000
+        return not len(self._inflight) and network_quiet_ms >= self.quiet_ms
+
+    # state is what READY_CHECK_JS returned
+    def _page_ready(self, state, start):
+        dom_quiet_ms = min(state['quietMs'], (time.monotonic() - start) * 1000)
+        return dom_quiet_ms >= self.quiet_ms and state['fontsReady'] and state['imagesReady']
+
+    def wait(self, max_wait_ms):
+        """
+        Waits until the page is ready (or for max_wait_ms, at most). Returns the time actually waited in ms.
+        """
+        start = time.monotonic()
+        if self.mode != 'adaptive':
+            self.page.wait_for_timeout(max_wait_ms)
+        else:
+            for sleep_ms in self._polls(start, max_wait_ms):
+                self.page.wait_for_timeout(sleep_ms)  # Also lets Playwright dispatch request events
+                if self._network_quiet(start) and self._page_ready(self.page.evaluate(READY_CHECK_JS), start):
+                    break
+        return round((time.monotonic() - start) * 1000)
+
+
+# The same with Playwright's async API; only the calls to the page differ
+class AsyncReadinessWatcher(ReadinessWatcher):
+    async def install(self):
+        if self.mode == 'adaptive':
+            await self.page.add_init_script(MUTATION_TRACKER_JS)
+            self._listen()
+
+    async def wait(self, max_wait_ms):
+        start = time.monotonic()
+        if self.mode != 'adaptive':
+            await self.page.wait_for_timeout(max_wait_ms)
+        else:
+            for sleep_ms in self._polls(start, max_wait_ms):
+                await self.page.wait_for_timeout(sleep_ms)
+                if self._network_quiet(start) and self._page_ready(await self.page.evaluate(READY_CHECK_JS), start):
+                    break
+        return round((time.monotonic() - start) * 1000)
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+import dns.resolver
+import dns.exception
+import ipaddress
+import threading
+import time
+import sys
+
+"""
+
+DNS resolution for the SSRF checks, with a cache that respects record TTLs.
+
+- A and AAAA records are looked up concurrently, and many hosts can be resolved at once (resolve_many)
+- Answers are cached for their TTL (clamped between min_ttl and max_ttl)
+- Failed lookups (e.g., the domain doesn't exist, or isn't a valid name) are cached for negative_ttl
+
+The API server uses this to validate URLs, then passes the IPs it checked to the worker, whose egress proxy (see egress_proxy.py) only connects to those IPs.
+That way, a host can't pass the check and then resolve to a private address when the browser connects.
+
+"""
+
+def is_private_ip(ip_str: str) -> bool:
+    """
+    Checks if the given IP address string (e.g., '10.0.0.1', '127.0.0.1')
+    is private, loopback, or link-local.
+    """
+    try:
+        ip_obj = ipaddress.ip_address(ip_str)
+        return (
+            ip_obj.is_loopback or
+            ip_obj.is_private or
+            ip_obj.is_reserved or
+            ip_obj.is_link_local or
+            ip_obj.is_multicast
+        )
+    except ValueError:
+        return True  # If it can't parse, treat as "potentially unsafe"
+
+
+class SafeResolver:
+    def __init__(self, timeout, min_ttl, max_ttl, negative_ttl, threads=8, allowed_hosts=()):
+        self.timeout = timeout
+        self.allowed_hosts = {h.lower() for h in allowed_hosts}  # Exempt from the private IP check (e.g., a local benchmark fixture server)
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.threads = threads
+        self._cache = {}  # host -> (ips or None, expires)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._resolver = None
+
+    @property
+    def executor(self):
+        # Made lazily so that the threads belong to the process using them, not a parent that forked it
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='resolver')
+        return self._executor
+
+    def _lookup(self, host, rdtype):
+        if self._resolver is None:
+            self._resolver = dns.resolver.Resolver()
+            self._resolver.lifetime = self.timeout
+        try:
+            answer = self._resolver.resolve(host, rdtype)
+            return [r.address for r in answer], answer.rrset.ttl
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, dns.resolver.NoNameservers):
+            return [], None
+        except dns.exception.Timeout:
+            return None, None
+        except dns.exception.DNSException as e:
+            # i.e., a malformed host (an empty or too long label) can't resolve, same as one that doesn't exist
+            print(f"DNS lookup for {host} failed: {e}", file=sys.stderr, flush=True)
+            return [], None
+
+    def _resolve_uncached(self, host):
+        a, aaaa = self.executor.submit(self._lookup, host, 'A'), self.executor.submit(self._lookup, host, 'AAAA')
+        (ips_a, ttl_a), (ips_aaaa, ttl_aaaa) = a.result(), aaaa.result()
+        if ips_a is None and ips_aaaa is None:
+            return None, None  # Timed out; not cached
+        ips = (ips_a or []) + (ips_aaaa or [])
+        ttls = [ttl for ttl in (ttl_a, ttl_aaaa) if ttl is not None]
+        ttl = min(max(min(ttls), self.min_ttl), self.max_ttl) if len(ttls) else self.negative_ttl
+        return ips, ttl
+
+    def seed(self, host, ips, ttl=None):
+        """
+        Caches already validated IPs for host (i.e., ones checked by the API server).
+        """
+        with self._lock:
+            self._cache[host.lower()] = (list(ips), time.monotonic() + (ttl or self.min_ttl))
+
+    def resolve(self, host):
+        """
+        Returns a list of IPs for host (empty if it doesn't resolve).
+        """
+        host = host.lower().strip('[]')
+        try:
+            ipaddress.ip_address(host)
+            return [host]  # Already an IP
+        except ValueError:
+            pass
+
+        with self._lock:
+            cached = self._cache.get(host)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        ips, ttl = self._resolve_uncached(host)
+        if ips is None:
+            print(f"DNS lookup for {host} timed out", file=sys.stderr, flush=True)
+            return []
+        with self._lock:
+            self._cache[host] = (ips, time.monotonic() + (ttl if len(ips) else self.negative_ttl))
+            if len(self._cache) > 10_000:  # Drop expired entries so the cache doesn't grow forever
+                now = time.monotonic()
+                self._cache = {h: v for h, v in self._cache.items() if v[1] > now}
+        return ips
+
+    def resolve_many(self, hosts):
+        """
+        Resolves distinct hosts concurrently, returning {host: ips}.
+        """
+        hosts = list(set(hosts))
+        if len(hosts) <= 1:
+            return {host: self.resolve(host) for host in hosts}
+        with ThreadPoolExecutor(max_workers=min(len(hosts), self.threads)) as executor:
+            return dict(zip(hosts, executor.map(self.resolve, hosts)))
+
+    def resolve_safe(self, host):
+        """
+        Returns (ips, None) if host resolves only to public IPs, otherwise (None, reason).
+        """
+        ips = self.resolve(host)
+        if not len(ips):
+            return None, f"cannot resolve domain {host}"
+        if host.lower().strip('[]') in self.allowed_hosts:
+            return ips, None
+        for ip in ips:
+            if is_private_ip(ip):
+                return None, f"IP {ip} for domain {host} is private/loopback/link-local."
+        return ips, None
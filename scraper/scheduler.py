@@ -0,0 +1,156 @@
+from admission import AdmissionRejected
+import threading
+import json
+import time
+import sys
+
+"""
+
+Priorities and per-key fair sharing.
+
+Scrapes are either interactive (/scrape) or bulk (/scrape/batch, and /jobs by default), and each priority has its own Celery queue.
+Some worker processes only take interactive work (see supervisord.conf), so a big crawl can't hold up interactive requests.
+
+Bulk jobs aren't sent to Celery right away. They wait in a list per API key, and a dispatcher moves them to the bulk queue round robin across keys,
+only as the workers have room (admission control; see admission.py). So one key's large crawl gets the same share of the workers as another key's handful of jobs.
+A job that can't be sent (i.e., the broker is unavailable) goes back to the front of its key's list; after a few tries, it's failed like a job whose scrape failed.
+
+Queue depth per key (jobs not yet started) is reported in /metrics. It's counted from a record per queued job, which is dropped when the job starts,
+or when it's cancelled or fails before starting, so jobs that never run don't stay counted.
+
+"""
+
+PRIORITIES = ['interactive', 'bulk']
+RING_KEY = "scrapeserv:fair:keys"  # Keys with pending bulk jobs, in round robin order (next one at the tail)
+PENDING_PREFIX = "scrapeserv:fair:pending"
+QUEUED_KEY = "scrapeserv:fair:queued_jobs"  # Job id -> key, priority, and when it was submitted, for jobs not yet started
+LOCK_KEY = "scrapeserv:fair:lock"
+
+
+def pending_key(owner):
+    return f"{PENDING_PREFIX}:{owner}"
+
+
+class FairScheduler:
+    def __init__(self, redis_client, dispatch, fail, max_pending_per_key, target_depth, get_queue_depth, poll_interval=0.2, full_retry_after=60, queued_ttl=60 * 60 * 24, max_dispatch_attempts=5):
+        self.redis = redis_client
+        self.dispatch = dispatch  # Sends a job to Celery; may raise AdmissionRejected
+        self.fail = fail  # Called with (job, exception) for a job that couldn't be sent after max_dispatch_attempts
+        self.max_dispatch_attempts = max_dispatch_attempts
+        self.max_pending_per_key = max_pending_per_key
+        self.target_depth = target_depth  # The bulk queue is kept about this short, so that order is decided here rather than by Celery
+        self.get_queue_depth = get_queue_depth
+        self.poll_interval = poll_interval
+        self.full_retry_after = full_retry_after  # Retry-After when a key has too many pending jobs
+        self.queued_ttl = queued_ttl  # Queued records older than this are dropped (i.e., the job was lost with a worker)
+        self._thread = None
+
+    def submit(self, owner, job):
+        """
+        Adds a bulk job (a JSON serializable dict) to owner's list, or raises AdmissionRejected if the key already has too many pending.
+        """
+        if self.redis.llen(pending_key(owner)) >= self.max_pending_per_key:
+            raise AdmissionRejected('Too many pending jobs for this key', self.full_retry_after)
+        with self.redis.lock(LOCK_KEY, timeout=10, blocking_timeout=5):
+            if self.redis.rpush(pending_key(owner), json.dumps(job)) == 1:
+                self.redis.lpush(RING_KEY, owner)  # First pending job for this key; joins at the back of the line (keys are served from the tail)
+        self.mark_queued(job['job_id'], owner, 'bulk')
+
+    def cancel(self, owner, job_ids):
+        """
+        Removes owner's pending bulk jobs with these job ids (i.e., their batch timed out), so they're never dispatched; returns how many.
+        """
+        job_ids = set(job_ids)
+        removed = 0
+        with self.redis.lock(LOCK_KEY, timeout=10, blocking_timeout=5):
+            for raw in self.redis.lrange(pending_key(owner), 0, -1):
+                if json.loads(raw)['job_id'] in job_ids:
+                    removed += self.redis.lrem(pending_key(owner), 1, raw)
+            if removed and self.redis.llen(pending_key(owner)) == 0:
+                self.redis.lrem(RING_KEY, 0, owner)
+        self.forget(*job_ids)
+        return removed
+
+    def mark_queued(self, job_id, owner, priority):
+        try:
+            self.redis.hset(QUEUED_KEY, job_id, json.dumps({'owner': owner, 'priority': priority, 'since': time.time()}))
+        except Exception as e:
+            print(f"Updating queue stats failed: {e}", file=sys.stderr, flush=True)
+
+    def forget(self, *job_ids):
+        """
+        Stops counting jobs as queued: they've started, or were cancelled or failed before starting.
+        """
+        if not len(job_ids):
+            return
+        try:
+            self.redis.hdel(QUEUED_KEY, *job_ids)
+        except Exception as e:
+            print(f"Updating queue stats failed: {e}", file=sys.stderr, flush=True)
+
+    def mark_started(self, job_id):
+        self.forget(job_id)
+
+    def dispatch_once(self):
+        """
+        Moves one job from the next key in the ring to Celery; returns whether it did.
+        """
+        if self.get_queue_depth() >= self.target_depth:
+            return False
+        with self.redis.lock(LOCK_KEY, timeout=10, blocking_timeout=5):
+            owner = self.redis.rpoplpush(RING_KEY, RING_KEY)  # Rotate (not LMOVE, which needs Redis 6.2; the image ships 5.0)
+            if owner is None:
+                return False
+            owner = owner.decode('utf-8')
+            raw = self.redis.lpop(pending_key(owner))
+            if raw is None:
+                self.redis.lrem(RING_KEY, 0, owner)
+                return True
+            job = json.loads(raw)
+            try:
+                self.dispatch(job)
+            except AdmissionRejected:
+                self.redis.lpush(pending_key(owner), raw)  # Same place in line
+                return False
+            except Exception as e:
+                # i.e., the broker or the admission lock wasn't available; the job goes back in line unless it keeps failing
+                job['attempts'] = job.get('attempts', 0) + 1
+                if job['attempts'] < self.max_dispatch_attempts:
+                    self.redis.lpush(pending_key(owner), json.dumps(job))
+                    raise e
+                print(f"Giving up on dispatching job {job['job_id']} after {job['attempts']} attempts: {e}", file=sys.stderr, flush=True)
+                self.fail(job, e)
+            if self.redis.llen(pending_key(owner)) == 0:
+                self.redis.lrem(RING_KEY, 0, owner)
+            return True
+
+    def _run(self):
+        while True:
+            try:
+                while self.dispatch_once():
+                    pass
+            except Exception as e:
+                print(f"Dispatching bulk jobs failed: {e}", file=sys.stderr, flush=True)
+                time.sleep(5)  # i.e., Redis is down; don't flood the logs
+            time.sleep(self.poll_interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name='fair-scheduler')
+            self._thread.start()
+
+    def stats(self):
+        """
+        Returns {(owner, priority): jobs waiting}, counting jobs in the per-key lists and in Celery's queues.
+        """
+        depths = {}
+        stale = []
+        for job_id, raw in self.redis.hgetall(QUEUED_KEY).items():
+            entry = json.loads(raw)
+            if entry['since'] < time.time() - self.queued_ttl:
+                stale.append(job_id)
+                continue
+            depths[(entry['owner'], entry['priority'])] = depths.get((entry['owner'], entry['priority']), 0) + 1
+        if len(stale):
+            self.redis.hdel(QUEUED_KEY, *stale)
+        return depths
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import sys
+import os
+
+"""
+
+Where scrape artifacts (screenshots and the main content file) are uploaded.
+
+The backend is chosen by the STORAGE_BACKEND environment variable:
+- "s3" (default): any S3-compatible store, configured with S3_BUCKET_NAME and optionally S3_ENDPOINT_URL (e.g., for MinIO) and S3_PUBLIC_URL
+- "local": a directory on the local filesystem (LOCAL_STORAGE_DIR), whose files are served by the API at /storage/<key> unless LOCAL_STORAGE_URL is set
+  (workers write there too, so with workers on other machines, it has to be a shared directory; use s3 instead)
+
+One storage object is made per process and reused, so the S3 client's connection pool and the bucket's region are only set up once.
+Uploads for a job happen concurrently (see upload_many).
+
+"""
+
+UPLOAD_THREADS = 8  # Max concurrent uploads per job (and size of the S3 connection pool)
+
+
+class Storage:
+    def put_file(self, path, key, content_type=None):
+        """
+        Uploads the file at path under key, returning its URL.
+        """
+        raise NotImplementedError()
+
+    def put_bytes(self, data, key, content_type=None):
+        """
+        Uploads data under key, returning its URL.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Deletes the object under key, if there is one.
+        """
+        raise NotImplementedError()
+
+    # source is either bytes or a file path
+    def put(self, source, key, content_type=None):
+        if isinstance(source, (bytes, bytearray)):
+            return self.put_bytes(source, key, content_type)
+        return self.put_file(source, key, content_type)
+
+    def upload_many(self, items):
+        """
+        Uploads (source, key, content_type) items concurrently, returning their URLs in the same order.
+        Each source is either bytes or a file path.
+        """
+        if len(items) <= 1:
+            return [self.put(*item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(len(items), UPLOAD_THREADS)) as executor:
+            return list(executor.map(lambda item: self.put(*item), items))
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket_name, endpoint_url=None, public_url=None, region=None):
+        import boto3
+        from botocore.config import Config
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.public_url = public_url
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(max_pool_connections=UPLOAD_THREADS, retries={'max_attempts': 3})
+        )
+        self._region = None
+
+    # Looked up once per process rather than once per upload
+    @property
+    def region(self):
+        if self._region is None:
+            location = self.client.get_bucket_location(Bucket=self.bucket_name).get('LocationConstraint')
+            self._region = location or 'us-east-1'  # us-east-1 buckets have no location constraint
+        return self._region
+
+    def url_for(self, key):
+        if self.public_url:
+            return f"{self.public_url.rstrip('/')}/{key}"
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}/{key}"
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+
+    def put_file(self, path, key, content_type=None):
+        extra_args = {'ContentType': content_type} if content_type else None
+        self.client.upload_file(path, self.bucket_name, key, ExtraArgs=extra_args)
+        return self.url_for(key)
+
+    def put_bytes(self, data, key, content_type=None):
+        extra_args = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket_name, Key=key, Body=data, **extra_args)
+        return self.url_for(key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, public_url=None):
+        self.root = root
+        self.public_url = public_url or '/storage'
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Storage key {key} is outside of the storage directory")
+        return path
+
+    def url_for(self, key):
+        return f"{self.public_url.rstrip('/')}/{key}"
+
+    def put_file(self, path, key, content_type=None):
+        dest = self.path_for(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest)
+        return self.url_for(key)
+
+    def put_bytes(self, data, key, content_type=None):
+        dest = self.path_for(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as fhand:
+            fhand.write(data)
+        return self.url_for(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        backend = os.getenv('STORAGE_BACKEND', 's3').lower()
+        if backend == 'local':
+            _storage = LocalStorage(
+                os.getenv('LOCAL_STORAGE_DIR', '/tmp/scrapeserv-storage'),
+                public_url=os.getenv('LOCAL_STORAGE_URL')
+            )
+        elif backend == 's3':
+            _storage = S3Storage(
+                os.getenv('S3_BUCKET_NAME'),
+                endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,
+                public_url=os.getenv('S3_PUBLIC_URL') or None,
+                region=os.getenv('AWS_REGION') or None
+            )
+        else:
+            print(f"Unknown STORAGE_BACKEND {backend}", file=sys.stderr, flush=True)
+            raise ValueError(f"Unknown STORAGE_BACKEND {backend}")
+    return _storage
@@ -1,27 +1,111 @@
 from celery import Celery
-from playwright.sync_api import sync_playwright, Error as PlaywrightError
-import resource
+from celery.signals import worker_process_shutdown, worker_shutdown, worker_ready
+from celery.worker import state as worker_state
+from playwright.sync_api import Error as PlaywrightError
+from browser_pool import BrowserPool, MemoryLimitExceeded, browser_rss_mb
+from async_browser_pool import AsyncBrowserPool
+from admission import AdmissionController, AdmissionRejected, NodeReporter, MemoryAwareAutoscaler, estimate_job_mb
+from scheduler import FairScheduler, PRIORITIES
+from encoder import ScreenshotEncoder
+from dedup import SegmentDeduper, DEDUP_MODES
+from readiness import ReadinessWatcher, AsyncReadinessWatcher, READINESS_MODES
+from filtering import ResourceFilter
+from resolver import SafeResolver
+from egress_proxy import EgressProxy
+from metrics import Metrics, StageTimings
+from progress import ProgressPublisher, publish_done
+from cancellation import CancelCheck
+from preflight import Preflight, is_html, stream_body, close as close_preflight
+from cache import ResultCache, make_cache_key
+from celery.result import AsyncResult
+from storage import get_storage
+from artifacts import ArtifactStore, make_ref_artifact, artifact_source, remove_file
+from dotenv import load_dotenv
+import threading
+import functools
+import asyncio
 import math
 import tempfile
 import os
-from PIL import Image
 import sys
+import json
+import mimetypes
+import uuid
+import urllib3
+import redis
+import psutil
+import time
+
+load_dotenv()  # Storage and Redis configuration (see storage.py and .env.example)
 
 # Server options
-MEM_LIMIT_MB = 4_000  # 4 GB memory threshold for child scraping process
-MAX_CONCURRENT_TASKS = 3
+ENGINE = os.getenv('SCRAPE_ENGINE', 'sync')  # sync: a worker process (and browser) per job; async: many jobs' pages per process, sharing its browser (see async_browser_pool.py). Set in the environment, since supervisord.conf picks Celery's pool by it
+ASYNC_PAGES_PER_BROWSER = 8  # With the async engine, most pages a worker process drives at once (also its number of Celery threads)
+ASYNC_PAGE_TIMEOUT = 120  # With the async engine, a page is closed and its job failed after this long (seconds)
+ASYNC_MEM_LIMIT_MB = 8_000  # With the async engine, the newest pages are stopped while a worker process and its browser use more than this much resident memory
+ASYNC_BROWSER_MAX_RSS_MB = 6_000  # With the async engine, the browser is recycled (once its pages are done) after its processes use more than this
+ASYNC_ENCODER_THREADS = 4  # With the async engine, threads per worker process that compress screenshots
+MEM_LIMIT_MB = 4_000  # A job is stopped if its worker process and browser use more than this much resident memory
+MAX_CONCURRENT_TASKS = 12  # Most worker processes per node (keep in sync with --autoscale in supervisord.conf); how many actually run depends on free memory and CPU
+MEM_HEADROOM_MB = 1_000  # Memory left free on each node when admitting jobs and adding worker processes
+MAX_CPU_PERCENT = 90  # New jobs are turned away (429) while every node's CPU is busier than this
+JOB_BASE_MB = 300  # Estimated memory for any job...
+JOB_FRAME_FACTOR = 4  # ...plus this many viewport-sized frames for rendering, plus the raw screenshots held at once (see admission.py)
+BROWSER_BASE_MB = 400  # Memory of an idle warm browser, counted when deciding whether a node can add a worker process
+MAX_QUEUED_PER_SLOT = 4  # Jobs that can wait per worker process before new ones are turned away
+ADMISSION_JOB_SECONDS = 10  # Rough duration of a job, used for Retry-After
+ADMISSION_RESERVATION_TTL = 60 * 2  # An admitted job's memory stays reserved until it starts, or at most this long (seconds)
+NODE_REPORT_INTERVAL = 2  # How often worker nodes publish their free memory and CPU (seconds)
+MAX_PENDING_PER_KEY = 1_000  # Bulk jobs one API key can have waiting before new ones are turned away
+BULK_QUEUE_TARGET = 2  # Bulk jobs are released to Celery round robin across keys, keeping its bulk queue about this short
+RATE_LIMIT_PER_MINUTE = 0  # Scrapes one API key can submit per minute (batches count each URL, so a bigger batch is rejected outright); 0 for no limit. Without API keys, every caller shares one limit
 DEFAULT_SCREENSHOTS = 5  # The max number of screenshots if the user doesn't set a max
 MAX_SCREENSHOTS = 10  # User cannot set max_screenshots above this value
 DEFAULT_WAIT = 1000  # Value for wait if a user doesn't set one (ms)
 MAX_WAIT = 5000  # A user cannot ask for more than this long of a wait (ms)
 SCREENSHOT_QUALITY = 85  # Argument to PIL image save
+CAPTURE_MODES = ['scroll', 'fullpage']  # scroll: scroll, wait, and capture each segment; fullpage: capture the page in one go (or a few) and slice it
+FULLPAGE_MAX_CAPTURE_HEIGHT = 16_000  # Tallest single capture in fullpage mode (px); taller pages are captured in several pieces
+READINESS_QUIET_MS = 300  # With readiness "adaptive", how long the network and DOM must be quiet before a capture (ms)
+READINESS_POLL_MS = 50  # How often readiness is checked (ms)
+DEFAULT_BLOCK_RESOURCE_TYPES = []  # Playwright resource types blocked unless a user sets their own block_resource_types (any blocking routes every request through Python; see filtering.py)
+DEFAULT_BLOCK_TRACKERS = False  # Block the ad/tracker domains in blocklist.txt unless a user sets block_trackers
+MAX_RESOURCE_BYTES = 50 * 1024 * 1024  # Most a user can set max_resource_bytes to
+DNS_TIMEOUT = 3  # Seconds before giving up on a DNS lookup
+DNS_MIN_TTL = 30  # DNS answers are cached for their TTL, but at least this long (seconds)...
+DNS_MAX_TTL = 60 * 60  # ...and at most this long
+DNS_NEGATIVE_TTL = 30  # Domains that don't resolve are remembered for this long (seconds)
+ENCODER_THREADS = 2  # Threads per worker process that compress screenshots while the browser keeps capturing
+DEFAULT_DEDUP = 'reference'  # What happens to screenshots that duplicate an earlier one if a user doesn't set dedup (see dedup.py); blank ones after the first are always dropped unless dedup is off
+DEFAULT_DEDUP_THRESHOLD = 0.02  # Screenshots whose hashes differ in at most this fraction of bits are duplicates
+MAX_DEDUP_THRESHOLD = 0.25  # Most a user can set dedup_threshold to
+BLANK_RATIO = 0.995  # A screenshot is blank if at least this fraction of its pixels are the same shade
+PREFLIGHT = True  # Check what a URL is with a plain HTTP request first, and skip the browser for anything that isn't an HTML page
+PREFLIGHT_TIMEOUT = 10  # Connect and read timeout for that request (seconds)
+PREFLIGHT_MAX_REDIRECTS = 10  # A URL that still redirects after this many fails
+PREFLIGHT_MAX_BYTES = 200 * 1024 * 1024  # Non-HTML content bigger than this fails the job
+PREFLIGHT_DEADLINE = 120  # ...as does content that takes longer than this to download in all (seconds)
 DEFAULT_BROWSER_DIM = [1280, 2000]  # If a user doesn't set browser dimensions  Width x Height in pixels
 MAX_BROWSER_DIM = [2400, 4000]  # Maximum width and height a user can set
 MIN_BROWSER_DIM = [100, 100]  # Minimum width and height a user can set
+MAX_BATCH_URLS = 500  # Maximum number of URLs in one request to /scrape/batch
+BATCH_TIMEOUT = 60 * 10  # A batch stops waiting for unfinished URLs after this long (seconds)
+ARTIFACT_SPILL_BYTES = 2 * 1024 * 1024  # Screenshots and content bigger than this are uploaded to storage by scrape_task rather than passed to finalize_job through Redis
+ORPHAN_ARTIFACT_TTL = 60 * 60  # Artifacts uploaded by scrape_task but never claimed by finalize_job (i.e., the job died) are deleted after this long (seconds)
+ARTIFACT_SWEEP_INTERVAL = 60 * 5  # How often each worker node looks for them (seconds)
+JOB_RESULT_TTL = 60 * 60 * 24  # Results of async jobs (/jobs) are kept for this long (seconds)
+CALLBACK_TIMEOUT = 10  # Timeout for notifying a job's callback URL (seconds)
+CACHE_TTL = 60 * 60  # Cached scrape results expire after this long (seconds); users can ask for fresher results with max_age
+CACHE_MAX_ENTRIES = 10_000  # Most results kept in Redis (least recently used are evicted)
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'scrapeserv-cache'))  # Disk tier of the result cache; set CACHE_DIR to nothing to turn it off (i.e., with several nodes)
+CACHE_MAX_DISK_MB = 500  # Most disk space used by the disk tier (least recently used are evicted)
+BROWSER_MAX_JOBS = 50  # A worker process' browser is relaunched after serving this many jobs
+BROWSER_MAX_RSS_MB = 2_000  # ...or once the browser's processes use more than this much resident memory
 USER_AGENT = "Mozilla/5.0 (compatible; Abbey/1.0; +https://github.com/US-Artificial-Intelligence/scraper)"
 
-CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
-CELERY_BROKER_URL = "redis://localhost:6379/0"
+# Every node (API and workers) must point at the same Redis (see .env.example)
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', "redis://localhost:6379/0")
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', "redis://localhost:6379/0")
 
 def make_celery():
     celery = Celery(
@@ -29,178 +113,837 @@ def make_celery():
         broker=CELERY_BROKER_URL
     )
     celery.conf.update(
-        worker_concurrency=MAX_CONCURRENT_TASKS,  # Limit number of concurrent tasks
+        worker_concurrency=ASYNC_PAGES_PER_BROWSER if ENGINE == 'async' else MAX_CONCURRENT_TASKS,  # Limit number of concurrent tasks (without --autoscale)
+        worker_autoscaler='admission:MemoryAwareAutoscaler',  # With --autoscale, only adds processes when there's memory for them
+        worker_prefetch_multiplier=1,  # Leave waiting jobs in the queue for whichever node has room first
+        task_default_queue='interactive',  # Queues are named after priorities (see scheduler.py)
+        task_track_started=True,  # So /jobs can report STARTED vs PENDING
+        result_expires=JOB_RESULT_TTL,
     )
 
     return celery
 
 celery = make_celery()
 
-@celery.task
-def scrape_task(url, wait, image_format, n_screenshots, browser_dim):
+result_cache = ResultCache(
+    redis.Redis.from_url(CELERY_RESULT_BACKEND),
+    disk_dir=CACHE_DIR or None,
+    ttl=CACHE_TTL,
+    max_entries=CACHE_MAX_ENTRIES,
+    max_disk_mb=CACHE_MAX_DISK_MB
+)
+
+# One warm browser per worker process (see browser_pool.py)
+browser_pool = BrowserPool(
+    max_jobs=BROWSER_MAX_JOBS,
+    max_rss_mb=BROWSER_MAX_RSS_MB,
+    launch_timeout=10_000,  # 10s startup timeout
+    firefox_user_prefs={
+        # Send even localhost traffic through the egress proxy (Firefox bypasses proxies for it by default)
+        'network.proxy.allow_hijacking_localhost': True,
+        'network.proxy.no_proxies_on': '',
+    }
+)
+
+# With the async engine, one warm browser per worker process shared by its jobs' pages (see async_browser_pool.py)
+async_browser_pool = AsyncBrowserPool(
+    max_pages=ASYNC_PAGES_PER_BROWSER,
+    max_jobs=BROWSER_MAX_JOBS,
+    max_rss_mb=ASYNC_BROWSER_MAX_RSS_MB,
+    limit_mb=ASYNC_MEM_LIMIT_MB,
+    page_timeout=ASYNC_PAGE_TIMEOUT,
+    launch_timeout=10_000,
+    firefox_user_prefs=browser_pool.firefox_user_prefs
+)
+
+# Sizes a job for admission control and autoscaling (see admission.py)
+def estimate_cost_mb(browser_dim, n_screenshots, capture_mode='scroll'):
+    return estimate_job_mb(browser_dim, n_screenshots, capture_mode, JOB_BASE_MB, JOB_FRAME_FACTOR, FULLPAGE_MAX_CAPTURE_HEIGHT)
+
+MemoryAwareAutoscaler.process_mb = BROWSER_BASE_MB + estimate_cost_mb(DEFAULT_BROWSER_DIM, DEFAULT_SCREENSHOTS)
+MemoryAwareAutoscaler.headroom_mb = MEM_HEADROOM_MB
+MemoryAwareAutoscaler.max_cpu_percent = MAX_CPU_PERCENT
+
+admission = AdmissionController(
+    redis.Redis.from_url(CELERY_RESULT_BACKEND),
+    headroom_mb=MEM_HEADROOM_MB,
+    max_cpu_percent=MAX_CPU_PERCENT,
+    max_queued_per_slot=MAX_QUEUED_PER_SLOT,
+    job_seconds=ADMISSION_JOB_SECONDS,
+    reservation_ttl=ADMISSION_RESERVATION_TTL
+)
+
+# Bulk jobs wait per API key and are released round robin (see scheduler.py); the dispatcher runs in the API server
+def dispatch_bulk_job(job):
+    admission.admit(job['job_id'], job['cost_mb'])
+    try:
+        celery.signature(job['sig']).apply_async(link_error=celery.signature(job['link_error']))
+    except Exception as e:
+        admission.release(job['job_id'])  # Never sent, so it shouldn't hold room on the workers
+        raise e
+
+# For a bulk job that couldn't be sent at all: it fails the way it would have if its scrape had
+def fail_bulk_job(job, exc):
+    try:
+        celery.backend.mark_as_failure(job['job_id'], exc)  # So that anything waiting on the job's result sees it finish
+    except Exception as e:
+        print(f"Could not mark job {job['job_id']} as failed: {e}", file=sys.stderr, flush=True)
+    celery.signature(job['link_error'])(None, exc, None)  # notify_job_failed, run here
+
+broker_redis = redis.Redis.from_url(CELERY_BROKER_URL)
+fair_scheduler = FairScheduler(
+    broker_redis,
+    dispatch=dispatch_bulk_job,
+    fail=fail_bulk_job,
+    max_pending_per_key=MAX_PENDING_PER_KEY,
+    target_depth=BULK_QUEUE_TARGET,
+    get_queue_depth=lambda: broker_redis.llen('bulk')
+)
+
+# For streaming progress to /scrape (see progress.py)
+progress_redis = redis.Redis.from_url(CELERY_RESULT_BACKEND)
+
+# Shared with the API server; see /metrics
+metrics = Metrics(redis.Redis.from_url(CELERY_RESULT_BACKEND))
+
+# Cached DNS for SSRF checks, in both the API server and the workers (see resolver.py)
+dns_resolver = SafeResolver(
+    timeout=DNS_TIMEOUT,
+    min_ttl=DNS_MIN_TTL,
+    max_ttl=DNS_MAX_TTL,
+    negative_ttl=DNS_NEGATIVE_TTL,
+    allowed_hosts=[h.strip() for h in os.getenv('SSRF_ALLOW_HOSTS', '').split(',') if h.strip()]  # Only for testing (see bench/)
+)
+
+# Browser traffic goes through this so that it only reaches validated, public IPs (see egress_proxy.py)
+_egress_proxy = None
+_egress_proxy_lock = threading.Lock()  # Several tasks can start at once with the async engine
+
+def get_egress_proxy():
+    global _egress_proxy
+    with _egress_proxy_lock:
+        if _egress_proxy is None:
+            _egress_proxy = EgressProxy(dns_resolver)
+            _egress_proxy.start()
+    return _egress_proxy
+
+# Passes scrape_task's outputs to finalize_job, wherever it runs (see artifacts.py)
+artifact_store = ArtifactStore(get_storage, redis.Redis.from_url(CELERY_RESULT_BACKEND), ARTIFACT_SPILL_BYTES)
+
+# Fetches non-HTML URLs without the browser (see preflight.py)
+preflight = Preflight(
+    lambda: get_egress_proxy().url,
+    user_agent=USER_AGENT,
+    timeout=PREFLIGHT_TIMEOUT,
+    max_redirects=PREFLIGHT_MAX_REDIRECTS
+)
+
+# Compresses screenshots alongside capture (see encoder.py)
+screenshot_encoder = ScreenshotEncoder(threads=ASYNC_ENCODER_THREADS if ENGINE == 'async' else ENCODER_THREADS)
+
+@worker_process_shutdown.connect
+def shutdown_browser_pool(**kwargs):
+    browser_pool.shutdown()
+
+# The async engine runs in the worker's main process (Celery's thread pool), which doesn't send worker_process_shutdown
+@worker_shutdown.connect
+def shutdown_async_browser_pool(**kwargs):
+    async_browser_pool.shutdown()
+
+# Each worker node publishes its capacity for admission control
+@worker_ready.connect
+def start_node_reporter(sender, **kwargs):
+    pool = sender.pool
+
+    # Processes the node has, or could add with the memory it has free
+    def get_slots():
+        if ENGINE == 'async':
+            return pool.num_processes  # Threads, each with a page; the pool can't grow
+        by_memory = math.floor((psutil.virtual_memory().available / (1024 * 1024) - MEM_HEADROOM_MB) / MemoryAwareAutoscaler.process_mb)
+        return max(pool.num_processes, min(by_memory, sender.controller.max_concurrency or MAX_CONCURRENT_TASKS))
+
+    NodeReporter(
+        redis.Redis.from_url(CELERY_RESULT_BACKEND),
+        interval=NODE_REPORT_INTERVAL,
+        get_slots=get_slots,
+        get_busy=lambda: len(worker_state.active_requests)
+    ).start()
+
+    threading.Thread(target=sweep_artifacts, daemon=True, name='artifact-sweeper').start()
+
+
+# Deletes artifacts orphaned by jobs that died between scrape_task and finalize_job (only one node sweeps at a time)
+def sweep_artifacts():
+    while True:
+        time.sleep(ARTIFACT_SWEEP_INTERVAL)
+        try:
+            swept = artifact_store.sweep(ORPHAN_ARTIFACT_TTL)
+            if swept:
+                print(f"Swept {swept} orphaned artifacts", file=sys.stderr, flush=True)
+        except Exception as e:
+            print(f"Sweeping artifacts failed: {e}", file=sys.stderr, flush=True)
+
+
+# Where artifacts go in storage; scrape_task and finalize_job share a storage_key per job
+def content_key(storage_key, content_type):
+    return f"content/{storage_key}/main{get_ext_from_content_type(content_type)}"
+
+
+def screenshot_key(storage_key, i, image_format):
+    return f"screenshots/{storage_key}/{i}.{image_format}"
+
+
+def storage_content_type(content_type):
+    return content_type.split(';')[0].strip() or None
+
+
+def plan_fullpage_chunks(total_height, num_segments, segment_height, max_chunk_height=None):
+    """
+    Splits the segments of a fullpage capture into as few captures as possible, each at most max_chunk_height tall.
+    Segments are placed where scrolling would put them: the last one is clamped to the bottom of the page.
+    Returns a list of (chunk top, chunk height, [segment offsets within the chunk]).
+    """
+    if max_chunk_height is None:
+        max_chunk_height = FULLPAGE_MAX_CAPTURE_HEIGHT
+    bottom = max(total_height - segment_height, 0)
+    tops = [min(i * segment_height, bottom) for i in range(num_segments)]
+    per_chunk = max(max_chunk_height // segment_height, 1)
+    chunks = []
+    for i in range(0, len(tops), per_chunk):
+        group = tops[i:i+per_chunk]
+        chunk_top = group[0]
+        chunks.append((chunk_top, group[-1] + segment_height - chunk_top, [top - chunk_top for top in group]))
+    return chunks
+
+
+# Streams a segment (or fullpage slices, starting at first_segment) as soon as the encoder finishes it
+def publish_when_encoded(progress, future, first_segment, image_format):
+    if progress.channel is None:
+        return
+
+    def publish(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        for i, (encoded, sizes) in enumerate(result if isinstance(result, list) else [result]):
+            if encoded is not None:  # Dropped as blank or a duplicate
+                progress.publish_screenshot(first_segment + i, encoded, image_format, sizes)
+
+    future.add_done_callback(publish)
+
+
+# Tasks running in this process; more than one with the async engine
+_active_tasks = 0
+_active_tasks_lock = threading.Lock()
+
+def set_active_tasks(change):
+    global _active_tasks
+    with _active_tasks_lock:
+        _active_tasks += change
+        metrics.set_gauge('scrapeserv_active_tasks', _active_tasks)
+
+
+REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]  # Some in the 300s like Multiple Choice not included
+
+
+# Returns (status, headers, content artifact) if url can be scraped without the browser, otherwise None
+def fetch_without_browser(url, timings, storage_key):
+    with timings.stage('preflight'):
+        response = preflight.fetch(url)
+    if response is None:
+        return None
+    headers = dict(response.headers)
+    if response.status >= 400 or is_html(response.headers.get('Content-Type', '')):
+        close_preflight(response)  # The browser takes it from here
+        return None
+    content_type = response.headers.get('Content-Type', '')
+    writer = artifact_store.writer(content_key(storage_key, content_type), storage_content_type(content_type))
+    try:
+        with timings.stage('content'):
+            stream_body(response, writer.write, PREFLIGHT_MAX_BYTES, PREFLIGHT_DEADLINE)
+    except Exception as e:
+        writer.discard()
+        raise e
+    with timings.stage('content'):
+        content = writer.artifact()
+    return response.status, headers, content
+
+
+# Keeps the response for the page itself; page.on("response") sees it even when goto fails (i.e., for a download)
+class MainResponse:
+    def __init__(self, url):
+        self.url = url
+        self.response = None
+
+    def track(self, response):
+        # Check if it's the main resource
+        if response.url == self.url:
+            self.response = response
+        # ...or we just got a 302 and are going to a new URL to scrape
+        elif self.redirect_location():
+            self.response = response
+
+    # Where the main response redirects to, if it's a redirect
+    def redirect_location(self):
+        if self.response and self.response.status in REDIRECT_STATUS_CODES:
+            return self.response.headers.get('location')
+        return None
+
+    # Returns (status, headers, lowercase content type)
+    def info(self):
+        if not self.response:
+            raise Exception("Response was none")
+        headers = dict(self.response.headers)
+        return self.response.status, headers, headers.get("content-type", "").lower()
+
+
+# Unfortunately, a specific error isn't thrown for downloads - have to use the substring
+def is_download_error(e):
+    return "Download is starting" in str(e)
+
+
+# Downloads can be big, so they go to disk and then to storage
+def new_download_path():
+    fd, download_path = tempfile.mkstemp(prefix='scrapeserv-')
+    os.close(fd)
+    return download_path
+
+
+def screenshot_clip(browser_dim, top=0, height=None):
+    return {
+        "x": 0,
+        "y": top,
+        "width": browser_dim[0],
+        "height": browser_dim[1] if height is None else height
+    }
+
+
+def scroll_js(i, browser_dim):
+    return f"window.scrollTo(0, {i * browser_dim[1]})"
+
+
+PAGE_HEIGHT_JS = "() => document.documentElement.scrollHeight"
+
+
+# Returns the number of segments to capture for a page total_height tall
+def plan_segments(metadata, total_height, n_screenshots, segment_height):
+    metadata['original_screenshots_n'] = math.ceil(total_height / segment_height)
+    num_segments = min(metadata['original_screenshots_n'], n_screenshots)
+    metadata['truncated_screenshots_n'] = num_segments
+    return num_segments
+
+
+# Records a readiness wait (the one after load, or the one for a segment)
+def record_wait(metadata, timings, waited_ms, segment=False):
+    if segment:
+        metadata['wait_ms']['segments'].append(waited_ms)
+    else:
+        metadata['wait_ms']['load'] = waited_ms
+    timings.add('wait', waited_ms / 1000)
+
+
+# Hands a capture to the encoder: one segment, or fullpage slices at offsets starting at first_segment
+# Encoded while the next one is captured
+def queue_screenshot(raw, first_segment, offsets, browser_dim, image_format, deduper, encoding, batch, progress):
+    batch.inc('scrapeserv_bytes_total', len(raw), {'kind': 'captured'})
+    if offsets is None:
+        encoding.append(screenshot_encoder.submit(raw, image_format, SCREENSHOT_QUALITY, deduper=deduper, index=first_segment))
+    else:
+        encoding.append(screenshot_encoder.submit_slices(raw, offsets, browser_dim[1], image_format, SCREENSHOT_QUALITY, deduper=deduper, first_index=first_segment))
+    publish_when_encoded(progress, encoding[-1], first_segment, image_format)
+
+
+def publish_response(progress, status, headers):
+    progress.publish('response', status=status, headers={str(k).lower(): v for k, v in headers.items()})
+
+
+# Turns what capture or capture_async returns into (status, headers, content artifact)
+def make_content(status, headers, body, download_path, timings, storage_key):
+    content_type = headers.get('content-type', '')
+    if download_path is not None:
+        return status, headers, artifact_store.make_from_file(download_path, content_key(storage_key, content_type), storage_content_type(content_type))
+    if body is None:
+        return status, headers, None
+    with timings.stage('content'):
+        return status, headers, artifact_store.make(body, content_key(storage_key, content_type), storage_content_type(content_type))
 
-    # Memory limits for the task process
-    soft, hard = (MEM_LIMIT_MB * 1024 * 1024, MEM_LIMIT_MB * 1024 * 1024)
-    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))  # Browser should inherit this limit
 
-    content_file_tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-    content_file = content_file_tmp.name
+# The browser part of scrape_task with the sync engine
+# Returns (status, headers, body, download path); body is None for downloads, which are saved to download path instead
+# capture_async is the same with Playwright's async API; keep the two in step
+def capture(context, url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel):
+    resource_filter.install(context)
+    page = context.new_page()
+    watcher = ReadinessWatcher(page, readiness, quiet_ms=READINESS_QUIET_MS, poll_ms=READINESS_POLL_MS)
+    watcher.install()
 
-    raw_screenshot_files = []
+    # Set various security headers and limits
+    page.set_default_timeout(30000)  # 30 second timeout
+    page.set_default_navigation_timeout(30000)
+
+    main = MainResponse(url)
+    page.on("response", main.track)
+    set_stage('navigation')
+    navigation_start = time.monotonic()
+    download_path = None
+    # Navigate to the page
+    # If there's no download, screenshotting and request stuff proceeds as normal
+    # If a download is initiated, Playwright throws an error which you can then handle
+    try:
+        main.response = page.goto(url)
+        if main.redirect_location():
+            main.response = page.goto(main.redirect_location())
+    except PlaywrightError as e:
+        if not is_download_error(e):
+            raise e
+        # If I use this around the first response, a timeout will occur when there's no download.
+        # But there's still the same exception to handle even with the expect download... playwright can be hell sometimes
+        with page.expect_download() as download_info:
+            try:
+                page.goto(main.redirect_location() or url)
+            except PlaywrightError as e:
+                if not is_download_error(e):
+                    raise e
+        download = download_info.value
+        download_path = new_download_path()
+        try:
+            download.save_as(download_path)
+        except Exception as e:
+            remove_file(download_path)
+            raise e
+
+    timings.add('navigation', time.monotonic() - navigation_start)
+
+    # For a download, this is the response from main.track rather than from goto
+    status, headers, content_type = main.info()
+    publish_response(progress, status, headers)
+
+    if status >= 400 or download_path is not None:
+        return status, headers, None, download_path
+
+    # If this is an HTML page, take screenshots
+    # Between steps, the job stops if it's been cancelled (see cancellation.py)
+    cancel.check()
+    if "text/html" in content_type:
+        set_stage('capture')
+        record_wait(metadata, timings, watcher.wait(wait))
+        total_height = page.evaluate(PAGE_HEIGHT_JS)
+        num_segments = plan_segments(metadata, total_height, n_screenshots, browser_dim[1])
+
+        if capture_mode == 'fullpage':
+            # A few tall captures of the whole page, sliced into segments by the encoder
+            first_segment = 0
+            for chunk_top, chunk_height, offsets in plan_fullpage_chunks(total_height, num_segments, browser_dim[1]):
+                cancel.check()
+                with timings.stage('screenshot'):
+                    raw = page.screenshot(animations="disabled", full_page=True, clip=screenshot_clip(browser_dim, chunk_top, chunk_height))
+                queue_screenshot(raw, first_segment, offsets, browser_dim, image_format, deduper, encoding, batch, progress)
+                first_segment += len(offsets)
+        else:
+            for i in range(num_segments):
+                page.evaluate(scroll_js(i, browser_dim))
+                record_wait(metadata, timings, watcher.wait(wait), segment=True)
+                cancel.check()
+                with timings.stage('screenshot'):
+                    raw = page.screenshot(animations="disabled", clip=screenshot_clip(browser_dim))
+                queue_screenshot(raw, i, None, browser_dim, image_format, deduper, encoding, batch, progress)
+
+    # If not text/html, just retrieve the raw bytes
+    # Note that if not text/html, might've been caught by the download stuff above
+    cancel.check()
+    set_stage('content')
+    with timings.stage('content'):
+        body = main.response.body()
+    return status, headers, body, None
+
+
+# capture on the async browser pool's event loop (see async_browser_pool.py)
+# Anything blocking (like writing to Redis) is left to an executor, so the loop keeps driving other pages
+async def capture_async(context, url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel):
+    def check_cancelled():
+        return asyncio.get_running_loop().run_in_executor(None, cancel.check)
+
+    await resource_filter.install_async(context)
+    page = await context.new_page()
+    watcher = AsyncReadinessWatcher(page, readiness, quiet_ms=READINESS_QUIET_MS, poll_ms=READINESS_POLL_MS)
+    await watcher.install()
+
+    page.set_default_timeout(30000)  # 30 second timeout
+    page.set_default_navigation_timeout(30000)
+
+    main = MainResponse(url)
+    page.on("response", main.track)
+    set_stage('navigation')
+    navigation_start = time.monotonic()
+    download_path = None
+    try:
+        main.response = await page.goto(url)
+        if main.redirect_location():
+            main.response = await page.goto(main.redirect_location())
+    except PlaywrightError as e:
+        if not is_download_error(e):
+            raise e
+        async with page.expect_download() as download_info:
+            try:
+                await page.goto(main.redirect_location() or url)
+            except PlaywrightError as e:
+                if not is_download_error(e):
+                    raise e
+        download = await download_info.value
+        download_path = new_download_path()
+        try:
+            await download.save_as(download_path)
+        except Exception as e:
+            remove_file(download_path)
+            raise e
+
+    timings.add('navigation', time.monotonic() - navigation_start)
+
+    status, headers, content_type = main.info()
+    await asyncio.get_running_loop().run_in_executor(None, functools.partial(publish_response, progress, status, headers))
+
+    if status >= 400 or download_path is not None:
+        return status, headers, None, download_path
+
+    await check_cancelled()
+    if "text/html" in content_type:
+        set_stage('capture')
+        record_wait(metadata, timings, await watcher.wait(wait))
+        total_height = await page.evaluate(PAGE_HEIGHT_JS)
+        num_segments = plan_segments(metadata, total_height, n_screenshots, browser_dim[1])
+
+        if capture_mode == 'fullpage':
+            first_segment = 0
+            for chunk_top, chunk_height, offsets in plan_fullpage_chunks(total_height, num_segments, browser_dim[1]):
+                await check_cancelled()
+                with timings.stage('screenshot'):
+                    raw = await page.screenshot(animations="disabled", full_page=True, clip=screenshot_clip(browser_dim, chunk_top, chunk_height))
+                queue_screenshot(raw, first_segment, offsets, browser_dim, image_format, deduper, encoding, batch, progress)
+                first_segment += len(offsets)
+        else:
+            for i in range(num_segments):
+                await page.evaluate(scroll_js(i, browser_dim))
+                record_wait(metadata, timings, await watcher.wait(wait), segment=True)
+                await check_cancelled()
+                with timings.stage('screenshot'):
+                    raw = await page.screenshot(animations="disabled", clip=screenshot_clip(browser_dim))
+                queue_screenshot(raw, i, None, browser_dim, image_format, deduper, encoding, batch, progress)
+
+    await check_cancelled()
+    set_stage('content')
+    with timings.stage('content'):
+        body = await main.response.body()
+    return status, headers, body, None
+
+
+# The async engine's counterpart to the browser_pool block in scrape_task; returns (status, headers, content artifact)
+def scrape_with_async_engine(url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel, storage_key):
+    captured, info = async_browser_pool.run(
+        lambda context: capture_async(context, url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel),
+        viewport={"width": browser_dim[0], "height": browser_dim[1]},
+        accept_downloads=True,
+        user_agent=USER_AGENT,
+        proxy={"server": get_egress_proxy().url}
+    )
+    metadata['browser'] = {
+        'warm': info['warm'],
+        'jobs_served': info['jobs_served'],
+        'pages_open': info['pages_open'],  # On this worker process' browser when the job got its page, including its own
+    }
+    if not info['warm']:
+        timings.add('browser_launch', info['launch_seconds'])
+        batch.inc('scrapeserv_browser_launches_total')
+    timings.add('page_wait', info['page_wait_seconds'])
+    timings.add('browser_context', info['context_seconds'])
+    return make_content(*captured, timings, storage_key)
+
+
+@celery.task
+def scrape_task(url, wait, image_format, n_screenshots, browser_dim, capture_mode='scroll', readiness='fixed', filtering=None, resolved_ips=None, enqueued_at=None, reservation_id=None, owner='anonymous', priority='interactive', progress_id=None, dedup=DEFAULT_DEDUP, dedup_threshold=DEFAULT_DEDUP_THRESHOLD):
+    task_start = time.monotonic()
+    progress = ProgressPublisher(progress_redis, progress_id)
+    cancel = CancelCheck(progress_redis, reservation_id)  # See cancellation.py
+    storage_key = str(uuid.uuid4())  # Where artifacts too big for Redis are uploaded (see artifacts.py)
+    if reservation_id:  # The job id
+        admission.release(reservation_id)  # From here on, this job's memory shows up in the node's stats
+        fair_scheduler.mark_started(reservation_id)
+    batch = metrics.batch()
+    timings = StageTimings(batch)
+    if enqueued_at:
+        timings.add('queue_wait', max(time.time() - enqueued_at, 0))
+        batch.observe('scrapeserv_queue_wait_seconds', max(time.time() - enqueued_at, 0), {'key': owner[:12], 'priority': priority})
+
+    content = None  # An artifact (see artifacts.py)
+    encoding = []  # Futures from the encoder, in segment order
+    screenshots = []  # Compressed artifacts
     metadata = {
         'image_sizes': [],
         'original_screenshots_n': 0,
         'truncated_screenshots_n': 0,
+        'engine': 'browser',  # Or http, if the browser was skipped (see preflight.py)
+        'browser': None,
+        'wait_ms': {'load': None, 'segments': []},  # Time actually spent waiting for the page to be ready
+        'filtering': None,
+        'dedup': {'mode': dedup, 'duplicates': 0, 'blank': 0, 'bytes_saved': 0, 'dropped_segments': []},  # bytes_saved is estimated from the segments duplicated and the blank ones' encoded sizes
+        'timings': timings.timings,  # Seconds spent in each stage
+        'storage_key': storage_key,  # For finalize_job; not returned to the user
     }
+    deduper = SegmentDeduper(dedup_threshold, BLANK_RATIO) if dedup != 'off' else None
+    resource_filter = ResourceFilter(**(filtering or {}))
+
+    # The browser will connect to the IPs that the API server checked, rather than resolving again
+    for host, ips in (resolved_ips or {}).items():
+        dns_resolver.seed(host, ips)
     status = None
     headers = None
+    stage = 'browser'  # For labeling errors
     try:
-        with sync_playwright() as p:
-            # Should be resilient to untrusted websites
-            browser = p.firefox.launch(headless=True, timeout=10_000)  # 10s startup timeout
-            context = browser.new_context(viewport={"width": browser_dim[0], "height": browser_dim[1]}, accept_downloads=True, user_agent=USER_AGENT)
-
-            page = context.new_page()
-
-            # Set various security headers and limits
-            page.set_default_timeout(30000)  # 30 second timeout
-            page.set_default_navigation_timeout(30000)
-
-            processing_download = False
-
-            REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]  # Some in the 300s like Multiple Choice not included
-            
-            # Handle response will work even if goto fails (i.e., for download).
-            response = None
-            def handle_response(_response):
-                nonlocal response
-                # Check if it's the main resource
-                if _response.url == url:
-                    response = _response
-                # ...or we just got a 302 and are going to a new URL to scrape
-                elif response and response.status in REDIRECT_STATUS_CODES:
-                    response = _response
-
-            page.on("response", handle_response)
-            # Navigate to the page
-            # If there's no download, screenshotting and request stuff proceeds as normal
-            # If a download is initiated, Playwright throws an error which you can then handle
-            try:
-                response = page.goto(url)
-                if response and response.status in REDIRECT_STATUS_CODES:
-                    response = page.goto(response.headers.get('location'))
-            except PlaywrightError as e:
-                # Unfortunately, a specific error isn't thrown - have to use the substring
-                substr = "Download is starting"
-                if substr in str(e):
-                    # If I use this around the first response, a timeout will occur when there's no download.
-                    # But there's still the same exception to handle even with the expect download... playwright can be hell sometimes
-                    with page.expect_download() as download_info:
-                        try:
-                            if response and response.status in REDIRECT_STATUS_CODES:
-                                loc = response.headers.get('location')
-                                page.goto(loc)
-                            else:
-                                page.goto(url)
-                        except PlaywrightError as e:
-                            if substr in str(e):
-                                processing_download = True
-                                download = download_info.value
-                                download.save_as(content_file_tmp.name)
-                                # Note that this "response" isn't the one assigned in the try;
-                                # It's the one from handle_response
-                                status = response.status
-                                headers = response.headers
-                            else:
-                                raise e
-                else:
-                    raise e
+        set_active_tasks(1)  # Inside the try, so that the finally below always undoes it
+        cancel.check()  # i.e., it was cancelled while it waited in the queue, but started anyway
+        if PREFLIGHT:
+            stage = 'preflight'
+            fetched = fetch_without_browser(url, timings, storage_key)
+            if fetched is not None:
+                status, headers, content = fetched
+                metadata['engine'] = 'http'
+                publish_response(progress, status, headers)
+                return status, headers, content, screenshots, metadata
+            stage = 'browser'
+
+        def set_stage(name):
+            nonlocal stage
+            stage = name
+        if ENGINE == 'async':
+            status, headers, content = scrape_with_async_engine(url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel, storage_key)
+        else:
+            browser_start = time.monotonic()
+            with browser_pool.memory_guard(MEM_LIMIT_MB), browser_pool.new_context(viewport={"width": browser_dim[0], "height": browser_dim[1]}, accept_downloads=True, user_agent=USER_AGENT, proxy={"server": get_egress_proxy().url}) as (context, warm):
+                metadata['browser'] = {
+                    'warm': warm,
+                    'jobs_served': browser_pool.jobs_served + 1  # Including this one
+                }
+                if not warm:
+                    timings.add('browser_launch', browser_pool.last_launch_seconds)
+                    batch.inc('scrapeserv_browser_launches_total')
+                timings.add('browser_context', time.monotonic() - browser_start - (0 if warm else browser_pool.last_launch_seconds))
 
-            if not response:
-                raise Exception("Response was none")
-
-            status = response.status
-            headers = dict(response.headers) if response else {}
-            content_type = headers.get("content-type", "").lower()
-
-            if status >= 400:
-                pass
-            elif not processing_download:
-                status = response.status
-                headers = dict(response.headers)
-                content_type = headers.get("content-type", "").lower()
-
-                # If this is an HTML page, take screenshots
-                if "text/html" in content_type:
-                    page.wait_for_timeout(wait)
-
-                    # Get total page height
-                    total_height = page.evaluate("() => document.documentElement.scrollHeight")
-
-                    # Calculate number of segments needed
-                    metadata['original_screenshots_n'] = math.ceil(total_height / browser_dim[1])
-                    num_segments = min(metadata['original_screenshots_n'], n_screenshots)
-                    metadata['truncated_screenshots_n'] = num_segments
-
-                    raw_screenshot_files = []
-
-                    for i in range(num_segments):
-                        tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-
-                        start_y = i * browser_dim[1]
-                        page.evaluate(f"window.scrollTo(0, {start_y})")
-                        page.wait_for_timeout(wait)
-
-                        page.screenshot(
-                            path=tmp.name,
-                            animations="disabled",
-                            clip={
-                                "x": 0,
-                                "y": 0,
-                                "width": browser_dim[0],
-                                "height": browser_dim[1]
-                            }
-                        )
-
-                        raw_screenshot_files.append(tmp.name)
-                        tmp.close()
-
-                # If not text/html, just retrieve the raw bytes
-                # Note that if not text/html, might've been caught by the download stuff above
-                file_bytes = response.body()
-                content_file_tmp.write(file_bytes)
-                browser.close()
+                captured = capture(context, url, wait, image_format, n_screenshots, browser_dim, capture_mode, readiness, resource_filter, deduper, encoding, metadata, timings, batch, progress, set_stage, cancel)
+            status, headers, content = make_content(*captured, timings, storage_key)
+
+        if content is None:
+            content = artifact_store.make(b"", content_key(storage_key, ''))
+
+        metadata['filtering'] = resource_filter.stats
+
+        # Collect the compressed screenshots
+        # Encoding mostly overlaps with capture; this is only the time spent waiting on it afterward
+        stage = 'encode'
+        with timings.stage('encode_wait'):
+            kept = {}  # Segment index -> index in screenshots
+            for future in encoding:
+                result = future.result()
+                for encoded, sizes in (result if isinstance(result, list) else [result]):  # Lists come from fullpage slices
+                    segment = len(kept) + metadata['dedup']['duplicates'] + metadata['dedup']['blank']
+                    dropped = sizes.pop('dedup', None)
+                    if dropped is None:
+                        kept[segment] = len(screenshots)
+                        metadata['image_sizes'].append(sizes)
+                        screenshots.append(artifact_store.make(encoded, screenshot_key(storage_key, len(screenshots), image_format), f"image/{image_format}"))
+                        batch.inc('scrapeserv_bytes_total', sizes['compressed'], {'kind': 'encoded'})
+                    elif dropped == 'blank':
+                        metadata['dedup']['blank'] += 1
+                        metadata['dedup']['bytes_saved'] += sizes['compressed']
+                        metadata['dedup']['dropped_segments'].append(segment)
+                    else:
+                        metadata['dedup']['duplicates'] += 1
+                        earlier = kept[dropped['duplicate_of']]
+                        metadata['dedup']['bytes_saved'] += metadata['image_sizes'][earlier]['compressed']
+                        if dedup == 'reference':
+                            metadata['image_sizes'].append({**sizes, 'duplicate_of': earlier})
+                            screenshots.append(make_ref_artifact(earlier))
+                        else:
+                            metadata['dedup']['dropped_segments'].append(segment)
 
     except Exception as e:
-        for ss in raw_screenshot_files:
-            os.remove(ss)
-        content_file_tmp.close()
-        os.remove(content_file)
+        if deduper:
+            deduper.abort()
+        for future in encoding:
+            future.cancel()
+        artifact_store.discard(content)
+        for ss in screenshots:
+            artifact_store.discard(ss)
+        batch.inc('scrapeserv_errors_total', labels={'stage': stage, 'class': type(e).__name__})
+        batch.inc('scrapeserv_jobs_total', labels={'outcome': 'error'})
         raise e
 
-    # Compress the screenshot files
-    compressed_screenshot_files = []
-    for ss in raw_screenshot_files:
-        try:
-            tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-            o_size = os.path.getsize(ss)
-            with Image.open(ss) as img:
-                if img.mode == 'RGBA':  # Will throw an error unless converted
-                    img = img.convert('RGB')
-                img.save(tmp.name, image_format.upper(), quality=SCREENSHOT_QUALITY)
-            c_size = os.path.getsize(tmp.name)
-            metadata['image_sizes'] = {
-                'original': o_size,
-                'compressed': c_size
-            }
-            compressed_screenshot_files.append(tmp.name)
-        except Exception as e:
-            for css in compressed_screenshot_files:
-                os.remove(css)
-            content_file_tmp.close()
-            os.remove(content_file)
-            raise e
-        finally:
-            os.remove(ss)
+    finally:
+        timings.add('scrape_total', time.monotonic() - task_start)
+        set_active_tasks(-1)
+        metrics.set_gauge('scrapeserv_worker_rss_bytes', psutil.Process().memory_info().rss + browser_rss_mb() * 1024 * 1024)
+        batch.flush()
+
+    return status, headers, content, screenshots, metadata
+
+
+# Callbacks go through the egress proxy too, so that DNS rebinding can't point a checked URL somewhere internal
+_callback_http = None
+_callback_http_lock = threading.Lock()
+
+def get_callback_http():
+    global _callback_http
+    with _callback_http_lock:
+        if _callback_http is None:
+            _callback_http = urllib3.ProxyManager(get_egress_proxy().url)
+    return _callback_http
+
+
+# Sends the job's final JSON body to the user's callback URL (if there is one)
+# The URL has already been checked by the API server (see url_is_safe in app.py)
+# Redirects aren't followed, since their targets haven't been checked
+def notify_callback(callback_url, body):
+    if not callback_url:
+        return
+    try:
+        resp = get_callback_http().request(
+            'POST',
+            callback_url,
+            body=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'User-Agent': USER_AGENT},
+            redirect=False,
+            retries=False,
+            timeout=urllib3.Timeout(total=CALLBACK_TIMEOUT)
+        )
+        if resp.status >= 300:
+            print(f"Callback to {callback_url} answered {resp.status}", file=sys.stderr, flush=True)
+    except Exception as e:
+        print(f"Callback to {callback_url} failed: {e}", file=sys.stderr, flush=True)
+
+
+# Includes dot
+def get_ext_from_content_type(content_type: str):
+    mime_type = content_type.split(';')[0].strip()
+    extensions = mimetypes.guess_all_extensions(mime_type)
+    if len(extensions):
+        return f"{extensions[0]}"
+    return ""
+
+
+@celery.task
+def deliver_callback(callback_url, body):
+    notify_callback(callback_url, body)
+
+
+# Runs after scrape_task (see scrape_chain); uploads the screenshots and produces the JSON body returned to the user
+@celery.task
+def finalize_job(scrape_result, image_format, job_id=None, callback_url=None, cache_key=None, progress=False, done_channel=None):
+    status, headers, content, screenshots, metadata = scrape_result
+    headers = {str(k).lower(): v for k, v in headers.items()}  # make headers all lowercase (they're case insensitive)
+    job_key = metadata.pop('storage_key', None) or str(uuid.uuid4())
+    batch = metrics.batch()
+    timings = StageTimings(batch)
+    content_type = headers.get('content-type', '')
+    artifacts = [content, *screenshots]
+    # Only inline artifacts are uploaded here; big ones were already uploaded by scrape_task (see artifacts.py)
+    # Duplicate screenshots (see dedup.py) aren't uploaded again; they get the URL of the one they duplicate
+    inline = [(i, ss) for i, ss in enumerate(screenshots) if 'inline' in ss]
+    uploads = [(artifact_source(ss), screenshot_key(job_key, i, image_format), f"image/{image_format}") for i, ss in inline]
+    if 'inline' in content:
+        uploads.append((artifact_source(content), content_key(job_key, content_type), storage_content_type(content_type)))
+    try:
+        with timings.stage('upload'):
+            uploaded = get_storage().upload_many(uploads)
+        content_url = uploaded.pop() if 'inline' in content else content['url']
+        urls_by_index = dict(zip([i for i, _ in inline], uploaded))
+        urls_by_index.update({i: ss['url'] for i, ss in enumerate(screenshots) if 'stored' in ss})
+        uploaded_urls = [urls_by_index[ss['ref'] if 'ref' in ss else i] for i, ss in enumerate(screenshots)]
+        batch.inc('scrapeserv_bytes_total', sum(a['size'] for a in artifacts if 'ref' not in a), {'kind': 'uploaded'})
+        batch.inc('scrapeserv_jobs_total', labels={'outcome': 'success'})
+    except Exception as e:
+        batch.inc('scrapeserv_errors_total', labels={'stage': 'upload', 'class': type(e).__name__})
+        batch.inc('scrapeserv_jobs_total', labels={'outcome': 'error'})
+        for artifact in artifacts:
+            artifact_store.discard(artifact)
+        raise e
+    finally:
+        batch.flush()
+    artifact_store.claim(artifacts)
+    metadata['timings'] = {**metadata.get('timings', {}), **timings.timings}
+
+    body = {
+        'job_id': job_id,
+        'state': 'SUCCESS',
+        'success': True,
+        'status': status,
+        'headers': headers,
+        'content_url': content_url,
+        'screenshot_urls': uploaded_urls,
+        'metadata': metadata,
+    }
+    if cache_key and status < 500:  # Server errors are likely transient
+        result_cache.put(cache_key, {k: v for k, v in body.items() if k != 'job_id'})
+    metadata['cache'] = {'hit': False, 'age': None}
+    notify_callback(callback_url, body)
+    if progress:
+        ProgressPublisher(progress_redis, job_id).publish('result', body=body)
+    if done_channel:
+        publish_done(progress_redis, done_channel, job_id)
+    return body
+
+
+# Error callback for the scrape chain; only used to tell the user's callback URL that the job failed
+@celery.task
+def notify_job_failed(request, exc, traceback, job_id=None, callback_url=None, progress=False, done_channel=None):
+    print(f"Job {job_id} failed: {exc}", file=sys.stderr, flush=True)
+    fair_scheduler.forget(job_id)  # In case it failed before starting
+    if progress:
+        ProgressPublisher(progress_redis, job_id).publish('error', error="This is a generic error message; sorry about that.")
+    if done_channel:
+        publish_done(progress_redis, done_channel, job_id)
+    notify_callback(callback_url, {
+        'job_id': job_id,
+        'state': 'FAILURE',
+        'success': False,
+        'error': "This is a generic error message; sorry about that."
+    })
+
+
+# Scrape and then upload; the returned AsyncResult's id is the job id
+# If there's a fresh enough result in the cache (and no_cache isn't set), it's stored as the job's result right away instead
+# Otherwise, interactive jobs are only queued if admission control finds room for them, and bulk jobs wait their turn behind other keys' (see scheduler.py)
+# AdmissionRejected is raised if there's no room
+# owner identifies the API key (see get_owner in app.py)
+# With progress, the job publishes its progress on its channel (see progress.py); subscribe before calling, using your own job_id
+# With done_channel, the job publishes just that it's done there (see batch_channel in progress.py)
+# options are passed through to scrape_task as keyword arguments
+def scrape_chain(url, wait, image_format, n_screenshots, browser_dim, callback_url=None, max_age=None, no_cache=False, resolved_ips=None, owner='anonymous', priority='interactive', progress=False, job_id=None, done_channel=None, **options):
+    job_id = job_id or str(uuid.uuid4())
+    cache_key = make_cache_key(url, wait, image_format, n_screenshots, browser_dim, **options)
+
+    if not no_cache:
+        cached, age = result_cache.get(cache_key, max_age=max_age)
+        batch = metrics.batch()
+        batch.inc('scrapeserv_cache_total', labels={'result': 'miss' if cached is None else 'hit'})
+        batch.flush()
+        if cached is not None:
+            body = {**cached, 'job_id': job_id}
+            body['metadata'] = {**body['metadata'], 'cache': {'hit': True, 'age': round(age, 3)}}
+            celery.backend.store_result(job_id, body, 'SUCCESS')
+            if callback_url:
+                deliver_callback.delay(callback_url, body)
+            return AsyncResult(job_id, app=celery)
+
+    scrape_task_id = str(uuid.uuid4())
+    cost_mb = estimate_cost_mb(browser_dim, n_screenshots, options.get('capture_mode', 'scroll'))
+    sig = (
+        scrape_task.s(url, wait, image_format, n_screenshots, browser_dim, resolved_ips=resolved_ips, enqueued_at=time.time(), reservation_id=job_id, owner=owner, priority=priority, progress_id=job_id if progress else None, **options).set(task_id=scrape_task_id, queue=priority) |
+        finalize_job.s(image_format, job_id=job_id, callback_url=callback_url, cache_key=cache_key, progress=progress, done_channel=done_channel).set(task_id=job_id, queue=priority)
+    )
+    link_error = notify_job_failed.s(job_id=job_id, callback_url=callback_url, progress=progress, done_channel=done_channel).set(queue=priority)
 
-    return status, headers, content_file, compressed_screenshot_files, metadata
+    if priority == 'bulk':
+        fair_scheduler.submit(owner, {'job_id': job_id, 'cost_mb': cost_mb, 'sig': sig, 'link_error': link_error})
+    else:
+        admission.admit(job_id, cost_mb)
+        fair_scheduler.mark_queued(job_id, owner, priority)
+        sig.apply_async(link_error=link_error)
+    return AsyncResult(job_id, parent=AsyncResult(scrape_task_id, app=celery), app=celery)